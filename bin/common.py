@@ -55,8 +55,101 @@ import os.path
 shares_save_dir = 'save'
 shares_save_dir = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), shares_save_dir)
 
+# Saves are spread over subdirectories named by the first two hex digits
+# of md5 of the save name. They are gzip compressed with the given level,
+# 0 disables compression
+# required by spider.py
+shares_save_compress = 6
+# days to keep saves of previous scans ('.old') and saves renamed after
+# database integrity violations (with timestamp suffix)
+# required by spider.py
+shares_save_old_days = 7
+shares_save_failed_days = 30
+
+import hashlib
+import gzip
 def share_save_path(proto, host, port = 0):
-    return os.path.join(shares_save_dir, share_save_str(proto, host, port))
+    """ returns path where the share's save is written """
+    name = share_save_str(proto, host, port)
+    path = os.path.join(shares_save_dir, hashlib.md5(name).hexdigest()[:2], name)
+    if shares_save_compress > 0:
+        path += ".gz"
+    return path
+
+def share_save_paths(proto, host, port = 0):
+    """ returns all paths where the share's save could be found: current
+    layout first, then the other compression and flat layout of old versions """
+    path = share_save_path(proto, host, port)
+    other = path[:-3] if path.endswith(".gz") else path + ".gz"
+    return [path, other, os.path.join(shares_save_dir, share_save_str(proto, host, port))]
+
+def share_save_find(proto, host, port = 0):
+    """ returns path of the existing save of the share or None """
+    for path in share_save_paths(proto, host, port):
+        if os.path.isfile(path):
+            return path
+    return None
+
+def share_save_remove(proto, host, port = 0):
+    """ removes the share's save in any layout """
+    for path in share_save_paths(proto, host, port):
+        if os.path.isfile(path):
+            os.unlink(path)
+
+import re
+def save_compressed(path):
+    """ tells whether save is compressed, suffixes of new and previous saves
+    and of saves renamed after failures are ignored """
+    return re.sub(r'\.(new|old|\d+)$', '', path).endswith(".gz")
+
+def open_save(path, mode = "rb"):
+    """ opens save, compressed ones are (de)compressed on the fly """
+    if save_compressed(path):
+        return gzip.open(path, mode, max(shares_save_compress, 1))
+    return open(path, mode)
+
+import tempfile
+import threading
+import shutil
+class SaveInput:
+    """ makes save readable by scanners' '-u' parameter. Compressed save
+    is decompressed into a named pipe, or into a temporary file where
+    named pipes aren't available. Call close() after scanner exits """
+    def __init__(self, save):
+        self.dir = None
+        self.writer = None
+        if not save_compressed(save):
+            self.path = save
+            return
+        self.dir = tempfile.mkdtemp(prefix = "uguu")
+        self.path = os.path.join(self.dir, "save")
+        if hasattr(os, "mkfifo"):
+            os.mkfifo(self.path)
+            self.writer = threading.Thread(target = self.write, args = (save,))
+            self.writer.setDaemon(True)
+            self.writer.start()
+        else:
+            self.write(save)
+    def write(self, save):
+        try:
+            source = open_save(save)
+            file = open(self.path, "wb")
+            shutil.copyfileobj(source, file)
+            file.close()
+            source.close()
+        except IOError:
+            # scanner exited before reading the whole save
+            pass
+    def close(self):
+        while self.writer is not None and self.writer.isAlive():
+            # writer could wait for scanner to open the pipe
+            try:
+                os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self.writer.join(0.1)
+        if self.dir is not None:
+            shutil.rmtree(self.dir, True)
 
 import string
 def quote_for_shell(str):
@@ -64,6 +157,10 @@ def quote_for_shell(str):
 
 #locale for scanners output
 scanners_locale = "utf-8"
+#scanners which don't support '-u' option (names of executables),
+#spider makes patches of their output itself with treediff.py
+#required by spider.py
+scanners_without_diff = ()
 #path where scanners are, with trailing slash
 import subprocess
 scanners_path = os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -77,9 +174,13 @@ def run_scanner(cmd, ip, proto, port, ext = ""):
     _stderr = None
     if not scanners_logging:
         _stderr = subprocess.PIPE
+    # scanner gets its own process group, so it is killed along with the shell
+    _preexec = None
+    if os.name == 'posix':
+        _preexec = os.setsid
     process = subprocess.Popen(cmdline, shell = True, stdin = subprocess.PIPE,
                                stdout = subprocess.PIPE, stderr = _stderr,
-                               universal_newlines = True)
+                               universal_newlines = True, preexec_fn = _preexec)
     process.stdin.close()
     return process
 
@@ -127,6 +228,40 @@ default_ports = dict(zip(known_protocols, (445, 21, 80,)))
 wait_until_next_scan = "12 hour"
 wait_until_next_scan_failed = "2 hour"
 
+# Adaptive scheduling: spider learns average rate of changes of every share
+# (in changes per hour) from patches and plans the next scan when
+# scan_target_changes changes are expected. Interval is bound by
+# scan_interval_min and scan_interval_max hours, and a share is not scanned
+# more often than once in scan_duration_factor durations of its scan.
+# Repeated failures double wait_until_next_scan_failed up to
+# scan_failed_max hours
+# required by spider.py
+adaptive_scheduling = True
+scan_target_changes = 100
+scan_interval_min = 2
+scan_interval_max = 96
+scan_duration_factor = 20
+scan_failed_max = 48
+# weight of the last observation in the averages of change rate and scan duration
+scan_average_weight = 0.3
+
+# record every scan with its metrics in scan_history table,
+# records are kept for scan_history_days days
+# required by spider.py
+keep_scan_history = True
+scan_history_days = 90
+# spider chooses between loading patch and the whole contents by model of
+# database update time fitted to scan_history of the last cost_model_days
+# days (at most cost_model_samples scans of each mode). The model is refitted
+# every cost_model_refresh seconds. Until there are cost_model_min_samples
+# scans of each mode and in pipelined mode the fixed patch_fallback ratio is used
+# required by spider.py
+cost_model = True
+cost_model_days = 30
+cost_model_samples = 2000
+cost_model_min_samples = 20
+cost_model_refresh = 3600
+
 # Time periods required by lookup.py:
 #time period to wait until the next lookup test after successful lookup
 wait_until_next_lookup = "1 week"
@@ -140,4 +275,135 @@ wait_until_delete_empty_share = "1 month"
 # required by spider.py
 max_lines_from_scanner = 4000000
 
+# scanner is killed if it gives no output for scanner_stall_time seconds
+# or runs longer than scanner_time_budget seconds for its protocol
+# (protocols not listed are not limited). Progress of the output is
+# checked every scanner_watchdog_interval seconds. Killed scans are
+# retried in wait_until_next_scan_killed
+# required by spider.py
+scanner_watchdog_interval = 10
+scanner_stall_time = 600
+scanner_time_budget = {'smb': 4 * 3600, 'ftp': 6 * 3600, 'http': 4 * 3600}
+wait_until_next_scan_killed = "30 minute"
+
+# load full (non-patching) scans with COPY through staging tables
+# instead of INSERT batches
+# required by spider.py
+spider_copy_loader = True
+# number of rows buffered by spider before sending them with COPY
+copy_buffer_rows = 16384
+
+# update database while scanner is running instead of waiting for
+# the whole scanner output. Database transaction is kept open for the
+# whole scan in this mode
+# required by spider.py
+scan_pipelined = False
+# scanner output is passed to the database loader in chunks of
+# pipeline_chunk_lines lines, at most pipeline_queue_size chunks are queued
+pipeline_chunk_lines = 1024
+pipeline_queue_size = 64
+
+# non-patching scans load contents into a new tree and swap it with the
+# old one on commit, so searches see the old contents while loading.
+# Requires 'dbinit.py --upgrade' for databases created by older versions
+# required by spider.py
+full_rescan_rebuild = False
+# old trees and names of no files are deleted by spider in batches of
+# purge_batch_rows rows with a pause of purge_batch_pause seconds between
+# batches
+purge_batch_rows = 10000
+purge_batch_pause = 0.5
+# spider counts rows it changes in paths and files and analyzes a table
+# after maintenance_analyze_rows plus maintenance_analyze_fraction of its
+# rows are changed, vacuums it after as many deletions and modifications
+# by vacuum settings. Partitions are processed the most stale first until
+# maintenance_time_budget seconds are spent, the rest are left to the next
+# run, partitioned tables are analyzed after their partitions. Maintenance
+# is an idle task of spider and 'spider.py --maintain', the tables should
+# be owned by db_user.
+# Requires 'dbinit.py --upgrade' for databases created by older versions
+# required by spider.py
+table_maintenance = True
+maintenance_analyze_rows = 50000
+maintenance_analyze_fraction = 0.02
+maintenance_vacuum_rows = 100000
+maintenance_vacuum_fraction = 0.05
+maintenance_time_budget = 600
+
+# renumber files of all modified directories with a single set-based
+# query instead of a cursor loop per directory when applying patches.
+# Requires 'dbinit.py --upgrade' for databases created by older versions
+# required by spider.py
+push_set_based = True
+# send deletions and modifications from patch with multi-row statements
+# instead of a statement per line
+# required by spider.py
+patch_batch_statements = True
+
+# number of names remembered by spider with their text prepared for
+# full text search
+# required by spider.py
+tsprepare_cache_size = 65536
+# make tsvectors in spider instead of calling to_tsvector() in the database.
+# Lexemes of every distinct word are asked from the database once and
+# remembered, spider should be restarted after changes of 'uguu' text
+# search configuration
+# required by spider.py
+client_tsvector = False
+# number of words with lexemes remembered by spider
+tsvector_cache_size = 262144
+# files refer to distinct names in names table by name_id, tsvectors of
+# names are kept there instead of files.tsname. Set it before
+# 'dbinit.py --makedb' or convert the database by 'dbinit.py --names'.
+# Requires 'dbinit.py --upgrade' for databases converted by older versions
+# this must be the same as in webuguu/common.py
+# required by spider.py and dbinit.py
+files_names_table = False
+# number of name ids remembered by spider
+# required by spider.py
+names_cache_size = 262144
 
+# number of hash partitions by tree_id of paths and files tables, None
+# keeps them single tables. Set it before 'dbinit.py --makedb' or convert
+# the database by 'dbinit.py --partition' (PostgreSQL 12 or later is required)
+# required by dbinit.py
+tree_partitions = None
+# number of connections building indexes in parallel, indexes of
+# partitioned tables are built partition by partition
+# required by dbinit.py
+index_workers = 4
+# maintenance_work_mem of every connection building indexes, i.e. '1GB',
+# None keeps the server's setting
+# required by dbinit.py
+index_work_mem = None
+
+
+# number of spider workers scanning shares in parallel,
+# could be overridden by '--workers N' spider's parameter
+# (shares are claimed with SKIP LOCKED, PostgreSQL 9.5 or later is required)
+# required by spider.py
+spider_workers = 1
+# period in seconds between spider's throughput reports
+spider_report_interval = 600
+# spider started with '--daemon' doesn't exit when no share is due, it sleeps
+# until the earliest next scan, but at most spider_daemon_sleep seconds, and
+# wakes at once when a share comes online. Removal of old trees and saves
+# runs at most every spider_idle_interval seconds in daemon mode
+spider_daemon_sleep = 600
+spider_idle_interval = 3600
+# share being scanned is leased by spider for lease_time seconds, lease is
+# extended every lease_heartbeat seconds. Leases of crashed spiders expire
+# and their shares are scanned again
+lease_time = 600
+lease_heartbeat = 60
+# limits of shares scanned at once by all spiders: per host name, per network
+# and per protocol (protocol -> limit), None or missing key for no limit.
+# scan_bandwidth_limit (network -> bytes per second) limits the sum of
+# expected output rates of scanners running in the network, expected rate
+# of a share is averaged over its past scans. A share is scanned anyway
+# when nothing else is running in its network
+# required by spider.py
+max_scans_per_host = 1
+max_scans_per_network = None
+max_scans_per_protocol = {}
+scan_bandwidth_limit = {}
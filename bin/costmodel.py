@@ -0,0 +1,110 @@
+#
+# costmodel.py - model of database update time in patching and non-patching modes
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+from common import cost_model_days, cost_model_samples, cost_model_min_samples
+
+# features of a scan (columns of scan_history) update time depends on.
+# Patching mode parses the listing too to know paths of modified
+# directories, files of modified directories are renumbered by push_tree_files
+features = {
+    'patch': ('patch_lines', 'listing_lines', 'modified_dirs', 'pushed_files'),
+    'full': ('listing_lines',),
+}
+
+# regularization of the scaled normal equations, keeps them solvable
+# when some features are collinear
+ridge = 1e-9
+
+def solve(a, b):
+    """ solves linear system a x = b by gaussian elimination with
+    partial pivoting, returns None for degenerate system """
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in xrange(n)]
+    for i in xrange(n):
+        p = max(xrange(i, n), key = lambda r: abs(m[r][i]))
+        if abs(m[p][i]) < 1e-15:
+            return None
+        m[i], m[p] = m[p], m[i]
+        for r in xrange(i + 1, n):
+            k = m[r][i] / m[i][i]
+            for c in xrange(i, n + 1):
+                m[r][c] -= k * m[i][c]
+    x = [0.0] * n
+    for i in xrange(n - 1, -1, -1):
+        x[i] = (m[i][n] - sum([m[i][c] * x[c] for c in xrange(i + 1, n)])) / m[i][i]
+    return x
+
+def fit_nonnegative(xs, ys):
+    """ least squares fit of y = sum(c[i] * x[i]) with non-negative
+    coefficients c. Features getting negative coefficient are dropped
+    one by one and the rest are fitted again. Columns are scaled to
+    [0, 1] since lines and seconds differ by orders of magnitude """
+    n = len(xs[0])
+    scale = [max([abs(x[i]) for x in xs]) for i in xrange(n)]
+    active = [i for i in xrange(n) if scale[i] > 0]
+    gram = [[sum([x[i] * x[j] for x in xs]) / (scale[i] * scale[j]) if i in active and j in active else 0.0
+             for j in xrange(n)] for i in xrange(n)]
+    moment = [sum([x[i] * y for x, y in zip(xs, ys)]) / scale[i] if i in active else 0.0
+              for i in xrange(n)]
+    coefficients = [0.0] * n
+    while active:
+        c = solve([[gram[i][j] + (ridge if i == j else 0.0) for j in active] for i in active],
+                  [moment[i] for i in active])
+        if c is None:
+            break
+        worst = min(xrange(len(active)), key = lambda k: c[k])
+        if c[worst] >= 0:
+            for k in xrange(len(active)):
+                coefficients[active[k]] = c[k] / scale[active[k]]
+            break
+        del active[worst]
+    return coefficients
+
+class CostModel:
+    """ linear models of update time in seconds of patching ('patch')
+    and non-patching ('full') modes. Coefficients go in order of features
+    with the constant term first """
+    def __init__(self, coefficients, samples):
+        self.coefficients = coefficients
+        self.samples = samples
+    def predict(self, mode, scan):
+        """ predicted update time of scan, a mapping of feature names to values """
+        c = self.coefficients[mode]
+        return c[0] + sum([c[i + 1] * (scan[features[mode][i]] or 0)
+                           for i in xrange(len(features[mode]))])
+    def describe(self, mode):
+        c = self.coefficients[mode]
+        terms = ["%.3g s" % c[0]] + ["%.3g * %s" % (c[i + 1], features[mode][i])
+                                     for i in xrange(len(features[mode]))]
+        return " + ".join(terms)
+
+def history(cursor, mode, days = cost_model_days, samples = cost_model_samples):
+    """ returns [(time, scan)] of the latest successful scans in mode,
+    time is update time, scan is a dict of features """
+    columns = features['patch']
+    cursor.execute("""
+        SELECT parse_time + db_time, %s FROM scan_history
+        WHERE outcome = 'success' AND mode = %%(m)s
+            AND started > now() - %%(d)s * interval '1 day'
+            AND db_time IS NOT NULL AND listing_lines IS NOT NULL
+        ORDER BY started DESC LIMIT %%(n)s
+        """ % ", ".join(columns), {'m': mode, 'd': days, 'n': samples})
+    return [(row[0], dict(zip(columns, row[1:]))) for row in cursor.fetchall()]
+
+def fit(cursor, days = cost_model_days, samples = cost_model_samples, min_samples = cost_model_min_samples):
+    """ fits model to scan_history, returns None if there are
+    less than min_samples scans of either mode """
+    coefficients = dict()
+    counts = dict()
+    for mode in features:
+        scans = history(cursor, mode, days, samples)
+        if len(scans) < min_samples:
+            return None
+        xs = [[1.0] + [float(s[f] or 0) for f in features[mode]] for t, s in scans]
+        coefficients[mode] = fit_nonnegative(xs, [t for t, s in scans])
+        counts[mode] = len(scans)
+    return CostModel(coefficients, counts)
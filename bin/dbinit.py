@@ -7,9 +7,13 @@
 #
 
 import psycopg2
+import psycopg2.extensions
 import sys
 import common
 import getpass
+import threading
+import Queue
+import time
 from common import connectdb, known_filetypes, known_protocols
 
 def db_is_empty(db):
@@ -53,13 +57,16 @@ def drop(db):
         DROP INDEX IF EXISTS filenames_name, files_type,
             paths_path, files_name, files_size, files_tsname,
             files_tsfullpath, trees_hash, shares_tree_id,
-            shares_hostname, shares_network, shares_state;
+            shares_hostname, shares_network, shares_state,
+            files_name_id, names_lname, names_tsname, paths_tspath;
         DROP TABLE IF EXISTS networks, scantypes, trees, shares,
-            paths, files CASCADE;
+            paths, files, names, scan_history, table_changes CASCADE;
+        DROP SEQUENCE IF EXISTS names_purges;
         """)
     safe_query(db, """
         DROP FUNCTION IF EXISTS share_update(), share_insert(),
             push_path_files(integer, integer),
+            push_tree_files(integer, integer[]),
             path_goup(integer, integer, integer) CASCADE
         """)
     cursor.execute("""
@@ -110,11 +117,29 @@ def ddl(db):
             last_state_change timestamp DEFAULT now(),
             last_scan timestamp,
             next_scan timestamp,
+            change_rate real,
+            scan_duration real,
+            scan_bandwidth real,
+            failed_scans smallint NOT NULL DEFAULT 0,
+            lease_owner varchar(64),
+            lease_expires timestamp,
             last_lookup timestamp DEFAULT now(),
             UNIQUE (protocol, hostname, port)
         );
         ALTER TABLE trees ADD CONSTRAINT trees_share_id_fkey FOREIGN KEY (share_id)
             REFERENCES shares (share_id) ON DELETE CASCADE;
+        """)
+    ddl_tree_tables(cursor, common.tree_partitions)
+    cursor.execute(ddl_scan_history)
+    cursor.execute(ddl_table_changes)
+
+
+def ddl_tree_tables(cursor, partitions = None):
+    """ creates paths and files, with partitions they are partitioned into
+    that many tables by hash of tree_id, primary key of files includes
+    tree_id then """
+    partitioned = partitions is not None
+    cursor.execute("""
         CREATE TABLE paths (
             tree_id integer REFERENCES trees ON DELETE CASCADE,
             treepath_id integer,
@@ -123,11 +148,13 @@ def ddl(db):
             path text NOT NULL,
             items integer NOT NULL DEFAULT 0,
             size bigint NOT NULL DEFAULT 0,
+            tspath tsvector,
             UNIQUE (tree_id, path),
             PRIMARY KEY (tree_id, treepath_id)
-        );
+        )%(p)s;
+        CREATE SEQUENCE IF NOT EXISTS files_file_id_seq;
         CREATE TABLE files (
-            file_id BIGSERIAL PRIMARY KEY,
+            file_id bigint NOT NULL DEFAULT nextval('files_file_id_seq'),
             tree_id integer,
             treepath_id integer,
             pathfile_id integer,
@@ -136,35 +163,108 @@ def ddl(db):
             name text NOT NULL,
             type filetype,
             tsname tsvector,
-            tspath tsvector,
             created timestamp DEFAULT now(),
+            PRIMARY KEY (%(k)s),
             FOREIGN KEY (tree_id, treepath_id) REFERENCES paths
                 ON DELETE CASCADE
+        )%(p)s;
+        ALTER SEQUENCE files_file_id_seq OWNED BY files.file_id;
+        """ % {'p': " PARTITION BY HASH (tree_id)" if partitioned else "",
+               'k': "file_id, tree_id" if partitioned else "file_id"})
+    if not partitioned:
+        return
+    for table in ('paths', 'files'):
+        for i in xrange(partitions):
+            cursor.execute("""
+                CREATE TABLE %(t)s_p%(i)s PARTITION OF %(t)s
+                    FOR VALUES WITH (MODULUS %(n)s, REMAINDER %(i)s)
+                """ % {'t': table, 'i': i, 'n': partitions})
+
+
+# distinct names of files with their tsvectors, files refer to them
+# when files_names_table is set. Spiders cache ids of names, names of
+# no files are deleted by spider's purge_names(), which advances
+# names_purges, so spiders know their cached ids could be gone
+ddl_names = """
+        CREATE TABLE IF NOT EXISTS names (
+            name_id SERIAL PRIMARY KEY,
+            name text NOT NULL UNIQUE,
+            lname text NOT NULL,
+            tsname tsvector
         );
-        """)
+        ALTER TABLE files ADD COLUMN IF NOT EXISTS name_id integer REFERENCES names;
+        CREATE SEQUENCE IF NOT EXISTS names_purges;
+        """
 
 
-# Warning: you may need to execute
-# "CREATE LANGUAGE 'plpgsql';" before calling this
-def ddl_prog(db):
-    safe_query(db, "CREATE LANGUAGE 'plpgsql'")
-    cursor = db.cursor()
-    cursor.execute("""
+# record of every scan made by spider, times are in seconds,
+# peak_memory is in kilobytes. Sizes of the patch and the listing,
+# directories modified by patch and files in them are what cost of
+# database update depends on, spider fits its cost model to them
+ddl_scan_history = """
+        CREATE TABLE IF NOT EXISTS scan_history (
+            share_id integer REFERENCES shares ON DELETE CASCADE,
+            started timestamp NOT NULL,
+            mode varchar(8),
+            outcome varchar(16) NOT NULL,
+            lines integer NOT NULL DEFAULT 0,
+            bytes bigint NOT NULL DEFAULT 0,
+            scanner_time real,
+            parse_time real,
+            db_time real,
+            rows_added integer,
+            rows_deleted integer,
+            rows_modified integer,
+            peak_memory integer,
+            patch_lines integer,
+            listing_lines integer,
+            modified_dirs integer,
+            pushed_files integer
+        );
+        CREATE INDEX IF NOT EXISTS scan_history_started ON scan_history (started);
+        CREATE INDEX IF NOT EXISTS scan_history_share ON scan_history (share_id);
+        """
+
+# rows changed by spider since the last ANALYZE and deleted or modified
+# since the last VACUUM of the table, see maintain_tables() in spider.py
+ddl_table_changes = """
+        CREATE TABLE IF NOT EXISTS table_changes (
+            relname varchar(64) PRIMARY KEY,
+            changed bigint NOT NULL DEFAULT 0,
+            dead bigint NOT NULL DEFAULT 0,
+            last_analyze timestamp,
+            last_vacuum timestamp
+        );
+        INSERT INTO table_changes (relname) VALUES ('paths'), ('files'), ('names')
+            ON CONFLICT DO NOTHING;
+        """
+
+
+# tree_id could be changed only to a tree attached to the same share,
+# this is used by spider to swap rebuilt tree in place of the old one.
+# Spiders running with --daemon are notified when a share comes online
+ddl_share_update = """
         CREATE OR REPLACE FUNCTION share_update()
             RETURNS trigger AS
             $$BEGIN
-                IF NEW.tree_id != OLD.tree_id AND OLD.tree_id IS NOT NULL THEN
-                    RAISE EXCEPTION 'tree_id cannot be changed (share_id=%)', NEW.share_id;
+                IF NEW.tree_id != OLD.tree_id AND OLD.tree_id IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM trees
+                        WHERE tree_id = NEW.tree_id AND share_id = NEW.share_id) THEN
+                    RAISE EXCEPTION 'tree_id can be changed only to a tree of the same share (share_id=%)', NEW.share_id;
                 END IF;
                 IF NEW.state != OLD.state THEN
                     NEW.last_state_change = 'now';
+                    IF NEW.state = 'online' THEN
+                        NOTIFY shares_online;
+                    END IF;
                 END IF;
                 RETURN NEW;
             END;$$
             LANGUAGE 'plpgsql' VOLATILE COST 100;
-        CREATE TRIGGER share_update_trigger
-            BEFORE UPDATE ON shares FOR EACH ROW
-            EXECUTE PROCEDURE share_update();
+        """
+
+# every share gets its tree, spiders are notified about new online shares
+ddl_share_insert = """
         CREATE OR REPLACE FUNCTION share_insert()
             RETURNS trigger AS
             $$BEGIN
@@ -175,9 +275,82 @@ def ddl_prog(db):
                 UPDATE shares
                 SET tree_id=NEW.tree_id
                 WHERE share_id=NEW.share_id;
+                IF NEW.state = 'online' THEN
+                    NOTIFY shares_online;
+                END IF;
                 RETURN NEW;
             END;$$
             LANGUAGE 'plpgsql' VOLATILE COST 100;
+        """
+
+# set-based version of push_path_files() for all modified directories
+# of a tree. Old files take free positions between new ones keeping
+# their order: old file with rank r in its directory gets position r
+# plus the number of new files preceded by at most r free positions
+ddl_push_tree_files = """
+        CREATE OR REPLACE FUNCTION push_tree_files(tid integer, dirs integer[])
+            RETURNS void AS
+            $$BEGIN
+                IF EXISTS (SELECT 1 FROM newfiles
+                           WHERE treepath_id = ANY(dirs)
+                           GROUP BY treepath_id, pathfile_id
+                           HAVING count(*) > 1) THEN
+                    RAISE check_violation;
+                END IF;
+                WITH shift AS (
+                    SELECT file_id, treedir_id, newid FROM (
+                        SELECT file_id, treedir_id, pathfile_id, isnew,
+                            slot + sum(isnew) OVER (PARTITION BY treepath_id
+                                ORDER BY slot, isnew DESC
+                                ROWS UNBOUNDED PRECEDING) AS newid
+                        FROM (
+                            SELECT file_id, treepath_id, treedir_id,
+                                pathfile_id, 0 AS isnew,
+                                row_number() OVER (PARTITION BY treepath_id
+                                    ORDER BY pathfile_id) - 1 AS slot
+                            FROM files
+                            WHERE tree_id = tid AND treepath_id = ANY(dirs)
+                            UNION ALL
+                            SELECT NULL, treepath_id, 0, pathfile_id, 1,
+                                pathfile_id - row_number() OVER (
+                                    PARTITION BY treepath_id
+                                    ORDER BY pathfile_id) + 1
+                            FROM newfiles
+                            WHERE treepath_id = ANY(dirs)
+                        ) AS merged
+                    ) AS numbered
+                    WHERE isnew = 0 AND newid != pathfile_id
+                ), movefiles AS (
+                    UPDATE files SET pathfile_id = shift.newid
+                    FROM shift
+                    WHERE files.tree_id = tid AND files.file_id = shift.file_id
+                )
+                UPDATE paths SET parentfile_id = shift.newid
+                FROM shift
+                WHERE paths.tree_id = tid
+                    AND paths.treepath_id = shift.treedir_id
+                    AND shift.treedir_id > 0;
+                INSERT INTO files
+                    SELECT * FROM newfiles
+                    WHERE treepath_id = ANY(dirs);
+                DELETE FROM newfiles
+                WHERE treepath_id = ANY(dirs);
+            END;$$
+            LANGUAGE 'plpgsql' VOLATILE COST 1000;
+        """
+
+# Warning: you may need to execute
+# "CREATE LANGUAGE 'plpgsql';" before calling this
+def ddl_prog(db):
+    safe_query(db, "CREATE LANGUAGE 'plpgsql'")
+    cursor = db.cursor()
+    cursor.execute(ddl_share_update)
+    cursor.execute(ddl_share_insert)
+    cursor.execute(ddl_push_tree_files)
+    cursor.execute("""
+        CREATE TRIGGER share_update_trigger
+            BEFORE UPDATE ON shares FOR EACH ROW
+            EXECUTE PROCEDURE share_update();
         CREATE TRIGGER share_insert_trigger
             AFTER INSERT ON shares FOR EACH ROW
             EXECUTE PROCEDURE share_insert();
@@ -240,7 +413,7 @@ def ddl_prog(db):
                     IF NOT N = oldrec.pathfile_id
                     THEN
                         UPDATE files SET pathfile_id = N
-                        WHERE file_id = oldrec.file_id;
+                        WHERE tree_id = tid AND file_id = oldrec.file_id;
                         IF oldrec.treedir_id > 0
                         THEN
                             UPDATE paths SET parentfile_id = N
@@ -260,20 +433,241 @@ def ddl_prog(db):
 	    """)
 
 
+# secondary indexes of the database: (name, table, definition, kind),
+# indexes of kind 'names' exist with files_names_table only, of kind
+# 'tsname' without it. Primary keys and unique constraints are not here,
+# foreign keys and spider's inserts of names rely on them
+indexes = [
+    ('shares_hostname', 'shares', "USING hash(hostname)", None),
+    ('shares_network', 'shares', "USING hash(network)", None),
+    ('shares_state', 'shares', "USING hash(state)", None),
+    ('shares_tree_id', 'shares', "(tree_id)", None),
+    ('paths_path', 'paths', "USING hash(path)", None),
+    ('paths_tspath', 'paths', "USING gin(tspath) WITH (FASTUPDATE = OFF)", None),
+    ('files_id', 'files', "(tree_id, treepath_id, pathfile_id)", None),
+    ('files_type', 'files', "(type)", None),
+    ('files_size', 'files', "(size)", None),
+    ('files_name', 'files', "USING hash(lower(name))", 'tsname'),
+    ('files_tsname', 'files', "USING gin(tsname) WITH (FASTUPDATE = OFF)", 'tsname'),
+    ('files_name_id', 'files', "(name_id)", 'names'),
+    ('names_lname', 'names', "USING hash(lname)", 'names'),
+    ('names_tsname', 'names', "USING gin(tsname) WITH (FASTUPDATE = OFF)", 'names'),
+]
+
+# tables partitioned with tree_partitions
+partitioned_tables = ('paths', 'files')
+
+def table_partitions(cursor, table):
+    """ returns names of partitions of table from the catalog, none if
+    the table isn't partitioned, e.g. isn't converted by --partition yet """
+    cursor.execute("""
+        SELECT c.relname FROM pg_partitioned_table AS p
+        JOIN pg_inherits AS i ON i.inhparent = p.partrelid
+        JOIN pg_class AS c ON c.oid = i.inhrelid
+        WHERE p.partrelid = %(t)s::regclass
+        ORDER BY c.relname
+        """, {'t': table})
+    return [row[0] for row in cursor.fetchall()]
+
+def secondary_indexes(kinds = None):
+    """ returns [(name, table, definition)] of indexes for the current
+    settings, only of given kinds if they are specified """
+    if kinds is None:
+        kinds = (None, 'names' if common.files_names_table else 'tsname')
+    return [i[:3] for i in indexes if i[3] in kinds]
+
+
+def make_indexes(db, indexes, workers = 1):
+    """ creates indexes which don't exist yet. With several workers indexes
+    are built in parallel by own connections, indexes of partitions are
+    built separately and attached to indexes of partitioned tables. The
+    transaction of db is committed then """
+    cursor = db.cursor()
+    if workers <= 1:
+        for index in indexes:
+            cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s %s" % index)
+        return
+    jobs = Queue.Queue()
+    # indexes of partitions as (index, its partition)
+    attach = []
+    for name, table, definition in indexes:
+        partitions = table_partitions(cursor, table) if table in partitioned_tables else []
+        if not partitions:
+            jobs.put((name, table, definition))
+            continue
+        cursor.execute("CREATE INDEX IF NOT EXISTS %s ON ONLY %s %s" % (name, table, definition))
+        for partition in partitions:
+            # partitions are named table_pN by ddl_tree_tables()
+            attach.append((name, name + partition[len(table):]))
+            jobs.put((attach[-1][1], partition, definition))
+    db.commit()
+    errors = []
+    def build():
+        conn = connectdb("dbinit")
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        if common.index_work_mem is not None:
+            conn.cursor().execute("SET maintenance_work_mem = %(m)s", {'m': common.index_work_mem})
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except Queue.Empty:
+                break
+            start = time.time()
+            try:
+                conn.cursor().execute("CREATE INDEX IF NOT EXISTS %s ON %s %s" % job)
+            except psycopg2.Error, e:
+                errors.append("%s: %s" % (job[0], e))
+                continue
+            print "Index %s is built in %.0f s." % (job[0], time.time() - start)
+        conn.close()
+    threads = [threading.Thread(target = build) for i in xrange(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception("Failed to build indexes, run 'dbinit.py --makeindex' "
+                        "to build the rest:\n" + "\n".join(errors))
+    for name, index in attach:
+        cursor.execute("ALTER INDEX %s ATTACH PARTITION %s" % (name, index))
+    db.commit()
+
+
+def drop_indexes(db):
+    """ drops all secondary indexes before loading of the whole
+    database by spider --bulk, indexes of partitions go with them """
+    db.cursor().execute("DROP INDEX IF EXISTS %s" % ", ".join([i[0] for i in indexes]))
+
+
 def ddl_index(db):
+    make_indexes(db, secondary_indexes())
+
+
+def convert_names(db):
+    """ moves names of files of existing database to names table,
+    files_names_table should be set afterwards """
+    cursor = db.cursor()
+    cursor.execute(ddl_names)
+    cursor.execute("""
+        INSERT INTO names (name, lname, tsname)
+            SELECT DISTINCT ON (name) name, lower(name), tsname
+            FROM files ORDER BY name
+            ON CONFLICT (name) DO NOTHING;
+        UPDATE files SET name_id = names.name_id, tsname = NULL
+            FROM names
+            WHERE names.name = files.name AND files.name_id IS NULL;
+        DROP INDEX IF EXISTS files_name, files_tsname, files_tsfullpath;
+        """)
+    make_indexes(db, secondary_indexes(('names',)), common.index_workers)
+
+
+def partition_tables(cursor):
+    """ moves paths and files to new tables partitioned by tree_id,
+    returns False if they can't be moved yet """
+    def columns(table):
+        cursor.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %(t)s
+            ORDER BY ordinal_position
+            """, {'t': table})
+        return [row[0] for row in cursor.fetchall()]
+    if 'tspath' in columns('files'):
+        print "Run with --upgrade first."
+        return False
+    # privileges of the old tables are given on the new ones
+    cursor.execute("""
+        SELECT c.relname, a.privilege_type, a.grantee::regrole::text
+        FROM pg_class AS c, aclexplode(c.relacl) AS a
+        WHERE c.relname IN ('paths', 'files') AND pg_table_is_visible(c.oid)
+            AND a.grantee != 0 AND a.grantee != c.relowner
+        """)
+    grants = cursor.fetchall()
+    cursor.execute("""
+        DROP INDEX IF EXISTS paths_path, paths_tspath, files_id, files_type,
+            files_size, files_name, files_tsname, files_tsfullpath, files_name_id;
+        ALTER TABLE files RENAME TO files_unpartitioned;
+        ALTER TABLE paths RENAME TO paths_unpartitioned;
+        ALTER INDEX files_pkey RENAME TO files_unpartitioned_pkey;
+        ALTER INDEX paths_pkey RENAME TO paths_unpartitioned_pkey;
+        ALTER INDEX paths_tree_id_path_key RENAME TO paths_unpartitioned_tree_id_path_key;
+        ALTER SEQUENCE files_file_id_seq OWNED BY NONE;
+        """)
+    ddl_tree_tables(cursor, common.tree_partitions)
+    if 'name_id' in columns('files_unpartitioned'):
+        cursor.execute(ddl_names)
+    for table in ('paths', 'files'):
+        names = ", ".join(columns(table + '_unpartitioned'))
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s_unpartitioned" % (table, names, names, table))
+    cursor.execute("DROP TABLE files_unpartitioned, paths_unpartitioned")
+    for table, privilege, grantee in grants:
+        cursor.execute("GRANT %s ON TABLE %s TO %s" % (privilege, table, grantee))
+    return True
+
+
+def convert_partitions(db):
+    """ moves paths and files of existing database to tables partitioned
+    by tree_id, tree_partitions should be set before. Tables are moved in
+    a transaction committed before indexes are built, so if building of
+    indexes fails, the next run builds missing ones and analyzes tables """
     cursor = db.cursor()
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = 'files' AND pg_table_is_visible(oid)")
+    if cursor.fetchone()[0] == 'p':
+        print "Files are partitioned already, building missing indexes."
+    elif not partition_tables(cursor):
+        return
+    make_indexes(db, [i for i in secondary_indexes() if i[1] in partitioned_tables],
+                 common.index_workers)
+    cursor.execute("ANALYZE paths; ANALYZE files;")
+
+
+def upgrade(db):
+    """ brings database created by previous versions up to date """
+    cursor = db.cursor()
+    cursor.execute(ddl_share_update)
+    cursor.execute(ddl_share_insert)
+    cursor.execute(ddl_push_tree_files)
+    cursor.execute("""
+        ALTER TABLE shares
+            ADD COLUMN IF NOT EXISTS change_rate real,
+            ADD COLUMN IF NOT EXISTS scan_duration real,
+            ADD COLUMN IF NOT EXISTS scan_bandwidth real,
+            ADD COLUMN IF NOT EXISTS failed_scans smallint NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS lease_owner varchar(64),
+            ADD COLUMN IF NOT EXISTS lease_expires timestamp;
+        """)
+    cursor.execute(ddl_scan_history)
+    cursor.execute("""
+        ALTER TABLE scan_history
+            ADD COLUMN IF NOT EXISTS patch_lines integer,
+            ADD COLUMN IF NOT EXISTS listing_lines integer,
+            ADD COLUMN IF NOT EXISTS modified_dirs integer,
+            ADD COLUMN IF NOT EXISTS pushed_files integer;
+        """)
+    cursor.execute(ddl_table_changes)
+    cursor.execute("SELECT 1 FROM pg_class WHERE relname = 'names' AND pg_table_is_visible(oid)")
+    if cursor.fetchone() is not None:
+        cursor.execute(ddl_names)
+    # tsvectors of paths are moved from every file to its directory,
+    # directories without files get vectors of paths prepared like
+    # spider's tsprepare() does
     cursor.execute("""
-        CREATE INDEX paths_path ON paths USING hash(path);
-        CREATE INDEX files_id ON files (tree_id, treepath_id, pathfile_id);
-        CREATE INDEX files_name ON files USING hash(lower(name));
-        CREATE INDEX files_tsname ON files USING gin(tsname) WITH (FASTUPDATE = OFF);
-        CREATE INDEX files_type ON files (type);
-        CREATE INDEX files_size ON files (size);
-        CREATE INDEX files_tsfullpath ON files USING gin((tspath || tsname)) WITH (FASTUPDATE = OFF);
-        CREATE INDEX shares_hostname ON shares USING hash(hostname);
-        CREATE INDEX shares_network ON shares USING hash(network);
-        CREATE INDEX shares_state ON shares USING hash(state);
-        CREATE INDEX shares_tree_id ON shares (tree_id);
+        ALTER TABLE paths ADD COLUMN IF NOT EXISTS tspath tsvector;
+        DO $$BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'files' AND column_name = 'tspath') THEN
+                UPDATE paths SET tspath = f.tspath
+                FROM (SELECT DISTINCT ON (tree_id, treepath_id) tree_id, treepath_id, tspath
+                      FROM files ORDER BY tree_id, treepath_id) AS f
+                WHERE paths.tree_id = f.tree_id AND paths.treepath_id = f.treepath_id;
+                DROP INDEX IF EXISTS files_tsfullpath;
+                ALTER TABLE files DROP COLUMN tspath;
+            END IF;
+        END;$$;
+        UPDATE paths SET tspath = to_tsvector('uguu', regexp_replace(
+                regexp_replace(path, '\\W', ' ', 'g'),
+                '([Ss])(\\d+)([Ee])(\\d+)', '\\1\\2\\3\\4 \\1\\2 \\3\\4 \\2 \\4 ', 'g'))
+        WHERE tspath IS NULL;
+        CREATE INDEX IF NOT EXISTS paths_tspath ON paths USING gin(tspath) WITH (FASTUPDATE = OFF);
         """)
 
 
@@ -357,6 +751,14 @@ def grant_access(db, db_user, ReadOnly):
                    {'d': common.db_database, 'u': db_user})
     cursor.execute("GRANT SELECT ON TABLE networks, scantypes TO %(u)s" %
                    {'u': db_user})
+    if common.files_names_table:
+        cursor.execute("GRANT SELECT ON TABLE names TO %(u)s" % {'u': db_user})
+        if not ReadOnly:
+            cursor.execute("""
+                GRANT INSERT, DELETE ON TABLE names TO %(u)s;
+                GRANT USAGE ON SEQUENCE names_name_id_seq TO %(u)s;
+                GRANT SELECT, USAGE ON SEQUENCE names_purges TO %(u)s;
+                """ % {'u': db_user})
     if ReadOnly:
         cursor.execute("""
             GRANT SELECT
@@ -366,14 +768,15 @@ def grant_access(db, db_user, ReadOnly):
     else:
         cursor.execute("""
             GRANT SELECT, INSERT, UPDATE, DELETE
-            ON TABLE shares, trees, paths, files
+            ON TABLE shares, trees, paths, files, scan_history, table_changes
             TO %(u)s;
             GRANT USAGE
             ON SEQUENCE shares_share_id_seq, trees_tree_id_seq, files_file_id_seq
             TO %(u)s;
             GRANT EXECUTE
             ON FUNCTION share_insert(), share_update(),
-                push_path_files(integer, integer)
+                push_path_files(integer, integer),
+                push_tree_files(integer, integer[])
             TO %(u)s;
             """ % {'u': db_user})
 
@@ -385,6 +788,11 @@ if __name__ == "__main__":
         print "  --dropdb\tdrop all uguu-related stuff from database"
         print "  --makedb\tinit uguu database"
         print "  --grant\tgrant access for R/O and R/W roles, use only with --makedb"
+        print "  --upgrade\tupgrade database created by previous uguu version"
+        print "  --names\tmove names of files to names table, set files_names_table afterwards"
+        print "  --partition\tmove paths and files to tables partitioned by tree, set tree_partitions before"
+        print "  --dropindex\tdrop secondary indexes before loading of the whole database"
+        print "  --makeindex\tbuild missing secondary indexes in parallel and analyze tables"
         print "  --\tmust be specified before dbusername starting with hyphen"
         sys.exit()
 
@@ -395,7 +803,7 @@ if __name__ == "__main__":
         sys.exit()
     common.db_password = getpass.getpass("%s's password: " % common.db_user)
     try:
-        db = connectdb()
+        db = connectdb("dbinit")
     except:
         print "I am unable to connect to the database, exiting."
         sys.exit()
@@ -403,6 +811,28 @@ if __name__ == "__main__":
     if '--dropdb' in sys.argv:
         drop(db)
         db.commit()
+    elif '--upgrade' in sys.argv:
+        upgrade(db)
+        db.commit()
+    elif '--names' in sys.argv:
+        convert_names(db)
+        db.commit()
+        print "Names are moved, run VACUUM FULL on files to reclaim space of tsname column."
+    elif '--dropindex' in sys.argv:
+        drop_indexes(db)
+        db.commit()
+    elif '--makeindex' in sys.argv:
+        start = time.time()
+        make_indexes(db, secondary_indexes(), common.index_workers)
+        db.cursor().execute("ANALYZE")
+        db.commit()
+        print "Indexes are built in %.0f s." % (time.time() - start)
+    elif '--partition' in sys.argv:
+        if common.tree_partitions is None:
+            print "Set tree_partitions in common.py first."
+            sys.exit()
+        convert_partitions(db)
+        db.commit()
     elif '--makedb' not in sys.argv:
         print "Invalid parameters, run with no parameters for help."
         sys.exit()
@@ -413,6 +843,8 @@ if __name__ == "__main__":
     if '--makedb' in sys.argv:
         ddl_types(db)
         ddl(db)
+        if common.files_names_table:
+            db.cursor().execute(ddl_names)
         ddl_prog(db)
         ddl_index(db)
         fill(db)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# dtgen.py - generator of synthetic scanner output for scale testing
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import math
+import bisect
+import random
+import hashlib
+import tempfile
+import treediff
+
+# file extensions with their weights and median sizes in bytes
+extensions = [
+    ('avi', 10, 700 << 20), ('mkv', 4, 1400 << 20), ('mp3', 30, 5 << 20),
+    ('flac', 3, 25 << 20), ('jpg', 25, 2 << 20), ('txt', 5, 4 << 10),
+    ('pdf', 6, 2 << 20), ('doc', 4, 200 << 10), ('rar', 5, 100 << 20),
+    ('iso', 2, 700 << 20), ('exe', 3, 10 << 20), ('srt', 3, 50 << 10),
+]
+# extensions of numbered series of files
+series_extensions = ['avi', 'mkv', 'mp3', 'flac', 'jpg']
+
+# syllables of words: latin and cyrillic, utf-8 encoded
+syllables = ["ka", "lo", "mi", "ne", "ser", "tor", "an", "bel", "dra", "fu",
+             "gro", "ix", "jo", "vy", "zen", "pri", "sto", "que", "re", "la"]
+cyrillic = [c + v for c in u"\u0431\u0432\u0434\u043a\u043b\u043c\u043d\u043f\u0440\u0441\u0442"
+                  for v in u"\u0430\u0435\u0438\u043e\u0443\u044f"]
+
+class Generator:
+    """ deterministic tree of a share in 'dt' format. Contents of every
+    directory are derived from the seed, the directory's path and the
+    version, so listings are written without keeping the tree in memory.
+    Directories have fanout subdirectories on average up to depth levels
+    and files files each. Names are made of words of vocabulary chosen
+    by Zipf law with the given exponent, sizes are log-normal around
+    medians of extensions with sigma. Every version deletes, modifies
+    and adds churn percent of files each and deletes and adds churn / 10
+    percent of directories """
+    def __init__(self, seed = 1, depth = 4, fanout = 4.0, files = 20.0,
+                 vocabulary = 2000, zipf = 1.1, sigma = 1.0, churn = 2.0):
+        self.seed = seed
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.zipf = zipf
+        self.sigma = sigma
+        self.churn = churn / 100.0
+        rand = self.random("", "words")
+        self.words = []
+        for i in xrange(vocabulary):
+            if rand.random() < 0.2:
+                word = u"".join([rand.choice(cyrillic) for j in xrange(rand.randint(1, 4))]).encode("utf-8")
+            else:
+                word = "".join([rand.choice(syllables) for j in xrange(rand.randint(1, 4))])
+            if rand.random() < 0.3:
+                word = word.capitalize()
+            self.words.append(word)
+        self.word_weights = self.cumulative([1.0 / (r + 1) ** zipf for r in xrange(vocabulary)])
+        self.ext_weights = self.cumulative([e[1] for e in extensions])
+    def cumulative(self, weights):
+        total = 0.0
+        result = []
+        for w in weights:
+            total += w
+            result.append(total)
+        return result
+    def pick(self, rand, weights):
+        return min(bisect.bisect(weights, rand.random() * weights[-1]), len(weights) - 1)
+    def random(self, path, salt):
+        key = hashlib.md5("%s/%s/%s" % (self.seed, salt, path)).hexdigest()
+        return random.Random(int(key[:16], 16))
+    def words_name(self, rand):
+        return " ".join([self.words[self.pick(rand, self.word_weights)]
+                         for i in xrange(rand.randint(1, 3))])
+    def size(self, rand, ext):
+        median = [e[2] for e in extensions if e[0] == ext][0]
+        return int(rand.lognormvariate(math.log(median), self.sigma))
+    def new_file(self, rand):
+        ext = extensions[self.pick(rand, self.ext_weights)][0]
+        return "%s.%s" % (self.words_name(rand), ext), ext
+    def count(self, rand, mean):
+        return int(rand.expovariate(1.0 / mean) + 0.5) if mean > 0 else 0
+    def base(self, path, level):
+        """ returns (set of subdirectory names, {file name: size}) of the first version """
+        rand = self.random(path, 0)
+        dirs = set()
+        if level < self.depth:
+            for i in xrange(self.count(rand, self.fanout)):
+                dirs.add(self.words_name(rand))
+        files = dict()
+        n = self.count(rand, self.files)
+        if n > 1 and rand.random() < 0.3:
+            # numbered series share name and extension
+            ext = rand.choice(series_extensions)
+            prefix = self.words_name(rand)
+            for i in xrange(n):
+                files["%s %02d.%s" % (prefix, i + 1, ext)] = self.size(rand, ext)
+            return dirs, files
+        for i in xrange(n):
+            name, ext = self.new_file(rand)
+            files[name] = self.size(rand, ext)
+        return dirs, files
+    def contents(self, path, level, version):
+        """ returns (sorted subdirectory names, {file name: size}) of the version """
+        dirs, files = self.base(path, level)
+        for v in xrange(1, version + 1):
+            rand = self.random(path, v)
+            for name in sorted(files.keys()):
+                r = rand.random()
+                if r < self.churn:
+                    del files[name]
+                elif r < 2 * self.churn:
+                    files[name] = self.size(rand, name[name.rfind('.') + 1:])
+                elif r < 3 * self.churn:
+                    name, ext = self.new_file(rand)
+                    files[name] = self.size(rand, ext)
+            for name in sorted(dirs):
+                if rand.random() < self.churn / 10:
+                    dirs.remove(name)
+            if level < self.depth:
+                for i in xrange(len(dirs) + 1):
+                    if rand.random() < self.churn / 10:
+                        dirs.add(self.words_name(rand))
+        return sorted(dirs), files
+    def write(self, file, version = 0):
+        """ writes full listing of the version in the same order and
+        with the same ids as dt_reverse() in scanners/libuguu/dt.c """
+        ids = [1]
+        def walk(path, level, id):
+            dirs, files = self.contents(path, level, version)
+            prefix = path + "/" if path else ""
+            children = []
+            for name in dirs:
+                ids[0] += 1
+                children.append(ids[0])
+                file.write("0 %s %s%s\n" % (ids[0], prefix, name))
+            size = 0
+            names = sorted(files.keys())
+            for i in xrange(len(names)):
+                file.write("1 %s %s %s 0 0 %s\n" % (id, len(dirs) + i, files[names[i]], names[i]))
+                size += files[names[i]]
+            stats = [walk(prefix + dirs[i], level + 1, children[i]) for i in xrange(len(dirs))]
+            for i in xrange(len(dirs)):
+                file.write("1 %s %s %s %s %s %s\n" % (id, i, stats[i][0], children[i], stats[i][1], dirs[i]))
+                size += stats[i][0]
+            return size, len(dirs) + len(names)
+        file.write("0 1 \n")
+        size, items = walk("", 0, 1)
+        file.write("1 0 0 %s 1 %s \n" % (size, items))
+
+def write_versions(generator, output, versions, full = False):
+    """ writes versions of the listing to output.0, output.1 and so on
+    (just output for a single version). The first one is full listing,
+    the next are patches against the previous file as scanner prints
+    them with '-u', unless full is set """
+    if versions == 1:
+        file = open(output, "wb")
+        generator.write(file)
+        file.close()
+        return
+    for v in xrange(versions):
+        path = "%s.%s" % (output, v)
+        if v == 0 or full:
+            file = open(path, "wb")
+            generator.write(file, v)
+            file.close()
+            continue
+        listing = tempfile.TemporaryFile()
+        generator.write(listing, v)
+        old = treediff.open_listing("%s.%s" % (output, v - 1))
+        new = treediff.Listing(listing)
+        file = open(path, "wb")
+        for line in treediff.diff(old, new):
+            file.write(line)
+        file.close()
+        old.close()
+        new.close()
+
+# options with their types and defaults
+options = {
+    '-s': ('seed', int, 1),
+    '-d': ('depth', int, 4),
+    '-f': ('fanout', float, 4.0),
+    '-F': ('files', float, 20.0),
+    '-w': ('vocabulary', int, 2000),
+    '-z': ('zipf', float, 1.1),
+    '-g': ('sigma', float, 1.0),
+    '-c': ('churn', float, 2.0),
+}
+
+def usage():
+    print "Usage: %s [options] [-n versions] [-full] output" % sys.argv[0]
+    print "Writes synthetic scanner output to output, or several versions of it to"
+    print "output.0, output.1 and so on, the next are patches to the previous ones."
+    for name in sorted(options.keys(), key = lambda x: x.lower()):
+        print "  %s %s\t(default %s)" % (name, options[name][0], options[name][2])
+    print "  -full\t\twrite every version as full listing"
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    params = dict()
+    versions = 1
+    full = False
+    try:
+        while len(args) > 1:
+            name = args.pop(0)
+            if name == '-full':
+                full = True
+            elif name == '-n':
+                versions = int(args.pop(0))
+            else:
+                params[options[name][0]] = options[name][1](args.pop(0))
+    except (KeyError, ValueError, IndexError):
+        usage()
+        sys.exit(1)
+    if len(args) != 1 or args[0].startswith('-') or versions < 1:
+        usage()
+        sys.exit(1)
+    write_versions(Generator(**params), args[0], versions, full)
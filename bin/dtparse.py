@@ -0,0 +1,74 @@
+#
+# dtparse.py - parser of libuguu 'dt' scanner output
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import array
+import string
+from common import log, scanners_locale
+
+# kinds of records
+PATH = 0
+FILE = 1
+
+patch_acts = ('+', '-', '*')
+
+def decode(s):
+    """ decodes name from scanner locale """
+    try:
+        return unicode(s, scanners_locale)
+    except:
+        log("Non utf-8 line occured: '%s'.", s)
+        return string.join([c if c in string.printable else "\\%#x" % ord(c) for c in s], "")
+
+def parse_line(line):
+    """ parses line of scanner output into a tuple
+    (act, PATH, id, path) or
+    (act, FILE, path, file, size, dirid, items, name)
+    where act is '+', '-', '*' for patch lines and None for the listing.
+    Only path and name are decoded """
+    if line[-1] == '\n':
+        line = line[:-1]
+    act = line[0]
+    if act in patch_acts:
+        line = line[2:]
+    else:
+        act = None
+    if line[0] == '0':
+        f = line.split(' ', 2)
+        return (act, PATH, int(f[1]), decode(f[2]) if len(f) > 2 else u"")
+    f = line.split(' ', 6)
+    return (act, FILE, int(f[1]), int(f[2]), int(f[3]), int(f[4]), int(f[5]),
+            decode(f[6]) if len(f) > 6 else u"")
+
+def parse(lines):
+    """ parses iterable of scanner output lines """
+    for line in lines:
+        yield parse_line(line)
+
+class DirTable:
+    """ state of directories being loaded indexed by directory id: whether
+    directory is known and whether it is modified by patch. Directory ids
+    from scanner are dense, so state is kept in an array """
+    def __init__(self):
+        self.state = array.array('b')
+    def grow(self, id):
+        if id >= len(self.state):
+            self.state.extend([0] * (id + 1 - len(self.state)))
+    def add(self, id, modify = False):
+        self.grow(id)
+        self.state[id] = 2 if modify else 1
+    def modified(self, id):
+        return id < len(self.state) and self.state[id] == 2
+    def pop(self, id):
+        """ forgets directory, returns whether it was modified """
+        if id >= len(self.state):
+            return False
+        modify = self.state[id] == 2
+        self.state[id] = 0
+        return modify
+    def modified_dirs(self):
+        """ returns ids of all known modified directories """
+        return [id for id in xrange(len(self.state)) if self.state[id] == 2]
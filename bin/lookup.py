@@ -16,7 +16,7 @@ import collections
 import traceback
 import datetime
 import psycopg2.extensions
-from common import connectdb, log, default_ports, run_scanner, wait_until_next_lookup, wait_until_delete_share, wait_until_delete_empty_share, share_save_path
+from common import connectdb, log, default_ports, run_scanner, wait_until_next_lookup, wait_until_delete_share, wait_until_delete_empty_share, share_save_remove
 from network import dns_cache, ns_domain, scan_all_hosts, get_host_list
 
 class Share(object):
@@ -158,7 +158,7 @@ returns permissions to add shares
                     """, {'st': share.scantype, 'net': self.__network, 'proto': share.proto,
                           'host': share.host, 'addr': share.Addr(), 'port': share.port})
                 try:
-                    os.unlink(share_save_path(share.proto, share.host, share.port))
+                    share_save_remove(share.proto, share.host, share.port)
                 except:
                     pass
         def UpdateHosts(_sharedict):
@@ -545,7 +545,7 @@ if __name__ == "__main__":
         """, {'tz': wait_until_delete_empty_share, 'tnz': wait_until_delete_share})
     for delrow in cursor.fetchall():
         try:
-            os.unlink(share_save_path(delrow['protocol'], delrow['hostname'], delrow['port']))
+            share_save_remove(delrow['protocol'], delrow['hostname'], delrow['port'])
         except:
             pass
     log("All network lookups finished (running time %s)", datetime.datetime.now() - start)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# report.py - reports on spider's work
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import costmodel
+from common import connectdb, sharestr, cost_model_days, cost_model_samples
+
+def report_load(cursor, hours = 24):
+    """ expected scan load per hour for the next hours """
+    cursor.execute("""
+        SELECT greatest(date_trunc('hour', next_scan), date_trunc('hour', now())) AS hour,
+            count(*) AS shares,
+            count(scan_duration) AS known,
+            coalesce(sum(scan_duration), 0) AS seconds
+        FROM shares
+        WHERE state = 'online'
+            AND (next_scan IS NULL OR next_scan < now() + %(h)s * interval '1 hour')
+        GROUP BY 1 ORDER BY 1
+        """, {'h': hours})
+    print "%-20s %8s %12s %10s" % ("hour", "shares", "scan time", "workers")
+    for row in cursor.fetchall():
+        print "%-20s %8d %12s %10.2f" % (row['hour'].strftime("%Y-%m-%d %H:00"),
+            row['shares'], "%d s%s" % (row['seconds'], "" if row['known'] == row['shares'] else "+"),
+            row['seconds'] / 3600.0)
+    cursor.execute("""
+        SELECT count(*) AS shares,
+            count(change_rate) AS known,
+            coalesce(sum(scan_duration), 0) AS seconds,
+            sum(CASE WHEN failed_scans > 0 THEN 1 ELSE 0 END) AS failing
+        FROM shares WHERE state = 'online'
+        """)
+    row = cursor.fetchone()
+    print "Online shares: %s (change rate known for %s, failing %s), total scan time %d s." % \
+        (row['shares'], row['known'], row['failing'], row['seconds'])
+    print "'+' marks hours with shares of unknown scan time, overdue shares are counted in the current hour."
+
+def report_slowest(cursor, count = 20, days = 7):
+    """ shares with the longest successful scans for the last days """
+    cursor.execute("""
+        SELECT protocol, hostname, port, count(*) AS scans,
+            avg(scanner_time) AS scanner, avg(parse_time) AS parse,
+            avg(db_time) AS db, avg(lines) AS lines,
+            sum(CASE WHEN mode = 'patch' THEN 1 ELSE 0 END) AS patches
+        FROM scan_history JOIN shares USING (share_id)
+        WHERE outcome = 'success' AND started > now() - %(d)s * interval '1 day'
+        GROUP BY share_id, protocol, hostname, port
+        ORDER BY avg(scanner_time + parse_time + db_time) DESC
+        LIMIT %(n)s
+        """, {'n': count, 'd': days})
+    print "%-40s %6s %8s %9s %9s %9s %10s" % ("share", "scans", "patches", "scanner", "parse", "db", "lines")
+    for row in cursor.fetchall():
+        print "%-40s %6d %8d %8.1fs %8.1fs %8.1fs %10d" % (
+            sharestr(row['protocol'], row['hostname'], row['port']),
+            row['scans'], row['patches'], row['scanner'], row['parse'], row['db'], row['lines'])
+
+def report_rates(cursor, days = 14):
+    """ scans and ingest rates per day for the last days """
+    cursor.execute("""
+        SELECT date_trunc('day', started) AS day, count(*) AS scans,
+            sum(CASE WHEN outcome = 'success' THEN 0 ELSE 1 END) AS failed,
+            sum(lines) AS lines, sum(bytes)::float8 AS bytes,
+            sum(scanner_time) AS scanner, sum(parse_time) AS parse, sum(db_time) AS db,
+            sum(rows_added + rows_deleted + rows_modified) AS rows,
+            max(peak_memory) AS memory
+        FROM scan_history
+        WHERE started > now() - %(d)s * interval '1 day'
+        GROUP BY 1 ORDER BY 1
+        """, {'d': days})
+    print "%-10s %6s %6s %10s %8s %10s %10s %10s %9s" % ("day", "scans", "failed", "lines", "MB",
+        "lines/s", "parse l/s", "db rows/s", "memory")
+    rate = lambda x, t: x / t if t else 0
+    for row in cursor.fetchall():
+        lines = row['lines'] or 0
+        print "%-10s %6d %6d %10d %8.1f %10.0f %10.0f %10.0f %7d kB" % (row['day'].strftime("%Y-%m-%d"),
+            row['scans'], row['failed'], lines, (row['bytes'] or 0) / 1048576.0,
+            rate(lines, (row['scanner'] or 0) + (row['parse'] or 0) + (row['db'] or 0)),
+            rate(lines, row['parse']), rate(row['rows'] or 0, row['db']), row['memory'] or 0)
+
+def report_costmodel(cursor, count = 20, days = cost_model_days):
+    """ cost model fitted to the last days and its predictions
+    of update time against observed one for the latest scans """
+    model = costmodel.fit(cursor, days, cost_model_samples, 1)
+    if model is None:
+        print "Not enough scans with known cost in both modes for the last %s days." % days
+        return
+    for mode in sorted(costmodel.features.keys()):
+        print "%s (%s scans): %s" % (mode, model.samples[mode], model.describe(mode))
+    cursor.execute("""
+        SELECT protocol, hostname, port, mode, parse_time + db_time AS time,
+            patch_lines, listing_lines, modified_dirs, pushed_files
+        FROM scan_history JOIN shares USING (share_id)
+        WHERE outcome = 'success' AND db_time IS NOT NULL AND listing_lines IS NOT NULL
+        ORDER BY started DESC LIMIT %(n)s
+        """, {'n': count})
+    print "%-40s %6s %9s %9s %9s %10s %10s" % ("share", "mode", "observed", "patch", "full",
+        "patch l", "listing l")
+    for row in cursor.fetchall():
+        print "%-40s %6s %8.1fs %8.1fs %8.1fs %10d %10d" % (
+            sharestr(row['protocol'], row['hostname'], row['port']), row['mode'], row['time'],
+            model.predict('patch', row), model.predict('full', row),
+            row['patch_lines'], row['listing_lines'])
+    for mode in sorted(costmodel.features.keys()):
+        scans = costmodel.history(cursor, mode, days)
+        error = sum([abs(model.predict(mode, s) - t) for t, s in scans]) / len(scans)
+        other = [m for m in costmodel.features.keys() if m != mode][0]
+        worse = len([s for t, s in scans if model.predict(other, s) < model.predict(mode, s)])
+        print "%s: mean absolute error %.2f s, %s of %s scans are predicted faster in %s mode." % \
+            (mode, error, worse, len(scans), other)
+
+def report_sizes(cursor):
+    """ sizes of tables and their indexes, partitioned tables
+    are summed over partitions """
+    cursor.execute("""
+        SELECT t.relname, count(i.inhrelid) AS partitions,
+            sum(pg_relation_size(p.oid))::float8 AS data,
+            sum(pg_indexes_size(p.oid))::float8 AS indexes,
+            sum(pg_total_relation_size(p.oid))::float8 AS total,
+            sum(greatest(p.reltuples, 0))::float8 AS reltuples
+        FROM pg_class AS t
+        LEFT JOIN pg_inherits AS i ON i.inhparent = t.oid
+        JOIN pg_class AS p ON p.oid = coalesce(i.inhrelid, t.oid)
+        WHERE t.relname IN ('files', 'names', 'paths', 'shares', 'trees', 'scan_history')
+            AND t.relkind IN ('r', 'p') AND pg_table_is_visible(t.oid)
+        GROUP BY t.relname
+        ORDER BY total DESC
+        """)
+    mb = lambda x: x / 1048576.0
+    print "%-14s %12s %10s %10s %10s %10s" % ("table", "rows", "data MB", "index MB", "total MB", "partitions")
+    for row in cursor.fetchall():
+        print "%-14s %12d %10.1f %10.1f %10.1f %10d" % (row['relname'], row['reltuples'],
+            mb(row['data']), mb(row['indexes']), mb(row['total']), row['partitions'])
+    print "Rows are estimated by the latest ANALYZE, total includes TOAST."
+
+reports = {
+    'load': (report_load, "[hours]", "expected scan load per hour"),
+    'slowest': (report_slowest, "[count [days]]", "shares with the longest scans"),
+    'rates': (report_rates, "[days]", "scans and ingest rates per day"),
+    'costmodel': (report_costmodel, "[count [days]]", "update cost model against observed times"),
+    'sizes': (report_sizes, "", "sizes of tables and indexes"),
+}
+
+def usage():
+    print "Usage: %s report [parameters]" % sys.argv[0]
+    print "Reports are:"
+    for name in sorted(reports.keys()):
+        print "  %s %s\t%s" % (name, reports[name][1], reports[name][2])
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in reports:
+        usage()
+        sys.exit()
+    try:
+        params = [int(x) for x in sys.argv[2:]]
+    except:
+        usage()
+        sys.exit()
+    try:
+        db = connectdb("report")
+    except:
+        print "I am unable to connect to the database, exiting."
+        sys.exit()
+    reports[sys.argv[1]][0](db.cursor(), *params)
+    db.rollback()
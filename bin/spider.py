@@ -21,16 +21,39 @@ import shutil
 import datetime
 import time
 import shutil
+import multiprocessing
+import Queue
+import cStringIO
+import threading
 import psycopg2.extensions
-from common import connectdb, log, scanners_locale, run_scanner, filetypes, wait_until_next_scan, wait_until_next_scan_failed, max_lines_from_scanner, sharestr, share_save_path, share_save_str, quote_for_shell, shares_save_dir
+import array
+import signal
+import select
+import subprocess
+import dtparse
+import treediff
+import costmodel
+from common import connectdb, log, run_scanner, filetypes, wait_until_next_scan, wait_until_next_scan_failed, max_lines_from_scanner, sharestr, share_save_path, share_save_find, open_save, SaveInput, share_save_str, quote_for_shell, shares_save_dir, shares_save_old_days, shares_save_failed_days, spider_workers, spider_report_interval, spider_daemon_sleep, spider_idle_interval, spider_copy_loader, copy_buffer_rows, scan_pipelined, pipeline_queue_size, pipeline_chunk_lines, full_rescan_rebuild, purge_batch_rows, purge_batch_pause, table_maintenance, maintenance_analyze_rows, maintenance_analyze_fraction, maintenance_vacuum_rows, maintenance_vacuum_fraction, maintenance_time_budget, push_set_based, patch_batch_statements, tsprepare_cache_size, client_tsvector, tsvector_cache_size, files_names_table, names_cache_size, adaptive_scheduling, scan_target_changes, scan_interval_min, scan_interval_max, scan_duration_factor, scan_failed_max, scan_average_weight, keep_scan_history, scan_history_days, lease_time, lease_heartbeat, max_scans_per_host, max_scans_per_network, max_scans_per_protocol, scan_bandwidth_limit, scanner_watchdog_interval, scanner_stall_time, scanner_time_budget, wait_until_next_scan_killed, scanners_without_diff, cost_model, cost_model_refresh
 
 # if patch is longer than whole contents / patch_fallback, then fallback
-# to non-patching mode
+# to non-patching mode, unless cost model tells which mode is faster
 patch_fallback = 0.8
 
+# channel notified by share_insert() and share_update() triggers
+# (see dbinit.py) when a share comes online and by spider when it
+# finishes scan, so shares held by concurrency limits could be claimed
+shares_channel = "shares_online"
+
+# key of advisory lock serializing claims when concurrency is limited,
+# two-key space is used since trees are locked by single keys
+claim_lock = (1, 0)
+
 # python 2.5 compitible shitcode
 def kill_process(process):
-    if sys.version_info[:2] < (2, 6):
+    if os.name == 'posix':
+        # scanner runs in the process group of the shell started by run_scanner
+        os.killpg(process.pid, signal.SIGKILL)
+    elif sys.version_info[:2] < (2, 6):
         if os.name == 'nt':
             subprocess.Popen("taskkill /F /T /PID %s >nul 2>nul" % process.pid, shell = True)
         else:
@@ -50,14 +73,232 @@ def suffix(filename):
         return string.lower(filename[dot + 1:])
 
 
-def tsprepare(string):
+class LRUCache:
+    """ dictionary holding at most size recently used items """
+    def __init__(self, size):
+        self.size = size
+        self.map = dict()
+        # circular doubly linked list of [prev, next, key, value] items
+        # ordered from the least recently used, root is the sentinel
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+    def __len__(self):
+        return len(self.map)
+    def __contains__(self, key):
+        return key in self.map
+    def get(self, key, default = None):
+        link = self.map.get(key)
+        if link is None:
+            return default
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0] = last
+        link[1] = self.root
+        return link[3]
+    def put(self, key, value):
+        link = self.map.get(key)
+        if link is not None:
+            link[3] = value
+            self.get(key)
+            return
+        if len(self.map) >= self.size:
+            oldest = self.root[1]
+            self.root[1] = oldest[1]
+            oldest[1][0] = self.root
+            del self.map[oldest[2]]
+        last = self.root[0]
+        link = [last, self.root, key, value]
+        last[1] = self.root[0] = self.map[key] = link
+
+def tsprepare_uncached(string):
     relax = re.sub(r'(?u)\W', ' ', string, re.UNICODE)
     relax = re.sub(r'(?u)([Ss])(\d+)([Ee])(\d+)',
                    '\\1\\2\\3\\4 \\1\\2 \\3\\4 \\2 \\4 ', relax, re.UNICODE)
     return relax
 
-fquery_append = "INSERT INTO %sfiles (tree_id, treepath_id, pathfile_id, treedir_id, size, name, type, tsname, tspath) VALUES "
-fquery_values = "(%(i)s, %(p)s, %(f)s, %(did)s, %(sz)s, %(n)s, %(t)s, to_tsvector('uguu', %(r)s), to_tsvector('uguu', %(rt)s))"
+tsprepare_cache = LRUCache(tsprepare_cache_size)
+
+def tsprepare(string):
+    relax = tsprepare_cache.get(string)
+    if relax is None:
+        relax = tsprepare_uncached(string)
+        tsprepare_cache.put(string, relax)
+    return relax
+
+# maximum position in tsvector
+ts_max_pos = 16383
+tsvector_lexeme = re.compile(r"'((?:[^']|'')*)'(?::([\d,]+))?")
+# lexemes of words: word -> ([(quoted lexeme, [positions])], positions used)
+ts_words = LRUCache(tsvector_cache_size)
+
+class TsVectorizer:
+    """ makes tsvector literals from text prepared by tsprepare(), they are
+    the same as to_tsvector('uguu', text) in the database. Text is split
+    at spaces and lexemes of every word are asked from the database once,
+    then they are taken from ts_words """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.wanted = dict()
+        self.resolved = dict()
+    def want(self, text):
+        """ registers text to be converted after resolve() """
+        for word in text.split():
+            if word not in ts_words:
+                self.wanted[word] = True
+    def resolve(self):
+        """ asks database for lexemes of all wanted words """
+        words = self.wanted.keys()
+        self.wanted = dict()
+        self.resolved = dict()
+        if len(words) == 0:
+            return
+        self.cursor.execute("""
+            SELECT i, to_tsvector('uguu', w)::text,
+                (SELECT count(*) FROM ts_debug('uguu', w) WHERE lexemes IS NOT NULL)
+            FROM unnest(%(w)s::text[]) WITH ORDINALITY AS u(w, i)
+            """, {'w': words})
+        for i, vector, count in self.cursor.fetchall():
+            lexemes = [(unicode(l, 'utf-8'), [int(p) for p in pos.split(',') if p])
+                       for l, pos in tsvector_lexeme.findall(vector)]
+            self.resolved[words[i - 1]] = (lexemes, count)
+            ts_words.put(words[i - 1], (lexemes, count))
+    def lexemes(self, word):
+        entry = self.resolved.get(word)
+        if entry is None:
+            entry = ts_words.get(word)
+        if entry is None:
+            self.wanted[word] = True
+            self.resolve()
+            entry = self.resolved[word]
+        return entry
+    def tsvector(self, text):
+        """ returns tsvector literal for text """
+        vector = dict()
+        pos = 0
+        for word in text.split():
+            lexemes, count = self.lexemes(word)
+            for lexeme, positions in lexemes:
+                vector.setdefault(lexeme, []).extend(
+                    [min(pos + p, ts_max_pos) for p in positions])
+            pos += count
+        return string.join([u"'%s':%s" % (l, string.join([str(p) for p in positions], ","))
+                            for l, positions in vector.iteritems()], " ")
+
+class NameResolver:
+    """ ids of file names in names table. New names are inserted on own
+    autocommit connection, so spiders loading the same names don't wait
+    for each other's transactions. Ids are remembered in ids until names
+    are purged, see sync() """
+    def __init__(self):
+        self.db = None
+        self.ids = LRUCache(names_cache_size)
+        self.wanted = dict()
+        # state of names_purges sequence when ids were remembered
+        self.purges = None
+    def sync(self, cursor):
+        """ keeps names from purge_names() until the end of transaction of
+        cursor, forgets ids if names were purged since the last call """
+        cursor.execute("SELECT pg_advisory_xact_lock_shared(%(k)s, %(j)s)",
+            {'k': names_lock[0], 'j': names_lock[1]})
+        cursor.execute("SELECT last_value, is_called FROM names_purges")
+        purges = tuple(cursor.fetchone())
+        if purges != self.purges:
+            self.ids = LRUCache(names_cache_size)
+            self.purges = purges
+    def cursor(self):
+        if self.db is None:
+            self.db = connectdb("spider")
+            self.db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return self.db.cursor()
+    def id(self, name):
+        """ returns id of name if it is known, otherwise registers
+        name to be inserted by resolve() and returns None """
+        id = self.ids.get(name)
+        if id is None:
+            self.wanted[name] = True
+        return id
+    def lookup(self, cursor, query, vars):
+        cursor.execute(query, vars)
+        for id, name in cursor.fetchall():
+            self.ids.put(unicode(name, 'utf-8'), id)
+    def resolve(self, vectorizer = None):
+        """ inserts all wanted names, tsvectors are made by vectorizer if it is given """
+        names = self.wanted.keys()
+        self.wanted = dict()
+        if len(names) == 0:
+            return
+        documents = [tsprepare(n) for n in names]
+        if vectorizer is not None:
+            for d in documents:
+                vectorizer.want(d)
+            vectorizer.resolve()
+            documents = [vectorizer.tsvector(d) for d in documents]
+            tsname = "r::tsvector"
+        else:
+            tsname = "to_tsvector('uguu', r)"
+        cursor = self.cursor()
+        # names are inserted in order, so concurrent spiders shouldn't deadlock
+        self.lookup(cursor, """
+            WITH new AS (
+                INSERT INTO names (name, lname, tsname)
+                SELECT n, lower(n), %s
+                FROM unnest(%%(n)s::text[], %%(r)s::text[]) AS u(n, r)
+                ORDER BY n
+                ON CONFLICT (name) DO NOTHING
+                RETURNING name_id, name
+            )
+            SELECT name_id, name FROM new
+            UNION ALL
+            SELECT name_id, name FROM names WHERE name = ANY(%%(n)s::text[])
+            """ % tsname, {'n': names, 'r': documents})
+        # names inserted by other spiders after the statement has started
+        missing = [n for n in names if n not in self.ids]
+        if len(missing) > 0:
+            self.lookup(cursor, "SELECT name_id, name FROM names WHERE name = ANY(%(n)s::text[])",
+                        {'n': missing})
+
+# NameResolver of the process, it is made on first use
+name_resolver = [None]
+# whether the whole database is loaded with secondary indexes dropped,
+# see 'dbinit.py --dropindex'
+bulk_load = [False]
+
+def names_resolver():
+    if name_resolver[0] is None:
+        name_resolver[0] = NameResolver()
+    return name_resolver[0]
+
+pquery_insert = "INSERT INTO paths (tree_id, treepath_id, path, tspath) VALUES (%(t)s, %(id)s, %(p)s, to_tsvector('uguu', %(r)s))"
+pquery_insert_tsvector = "INSERT INTO paths (tree_id, treepath_id, path, tspath) VALUES (%(t)s, %(id)s, %(p)s, %(r)s::tsvector)"
+fquery_append = "INSERT INTO %sfiles (tree_id, treepath_id, pathfile_id, treedir_id, size, name, type, tsname) VALUES "
+fquery_values = "(%(i)s, %(p)s, %(f)s, %(did)s, %(sz)s, %(n)s, %(t)s, to_tsvector('uguu', %(r)s))"
+fquery_values_tsvector = "(%(i)s, %(p)s, %(f)s, %(did)s, %(sz)s, %(n)s, %(t)s, %(r)s::tsvector)"
+# with files_names_table names unknown to spider are looked up when statement runs
+fquery_append_names = "INSERT INTO %sfiles (tree_id, treepath_id, pathfile_id, treedir_id, size, name, type, name_id) VALUES "
+fquery_values_names = "(%(i)s, %(p)s, %(f)s, %(did)s, %(sz)s, %(n)s, %(t)s, coalesce(%(nid)s, (SELECT name_id FROM names WHERE name = %(n)s)))"
+
+# multi-row statements for patch lines, rows are (query, values template)
+batch_queries = {
+    'fdelete': ("DELETE FROM files WHERE (tree_id, treepath_id, pathfile_id) IN (VALUES %s)",
+                "(%(t)s, %(p)s, %(f)s)"),
+    'fmodify': ("""
+        UPDATE files SET size = v.size
+        FROM (VALUES %s) AS v(tree_id, treepath_id, pathfile_id, size)
+        WHERE files.tree_id = v.tree_id AND files.treepath_id = v.treepath_id
+            AND files.pathfile_id = v.pathfile_id
+        """, "(%(t)s, %(p)s, %(f)s, %(sz)s::bigint)"),
+    'pdelete': ("DELETE FROM paths WHERE (tree_id, treepath_id) IN (VALUES %s)",
+                "(%(t)s, %(id)s)"),
+    'pmodify': ("""
+        UPDATE paths SET parent_id = v.parent_id, parentfile_id = v.parentfile_id,
+            items = v.items, size = v.size
+        FROM (VALUES %s) AS v(tree_id, treepath_id, parent_id, parentfile_id, items, size)
+        WHERE paths.tree_id = v.tree_id AND paths.treepath_id = v.treepath_id
+        """, "(%(t)s, %(d)s, %(p)s, %(f)s, %(i)s, %(sz)s::bigint)"),
+}
 
 class PsycoCache:
     def __init__(self, cursor):
@@ -71,86 +312,232 @@ class PsycoCache:
         self.stat_fadd = 0
         self.stat_fdelete = 0
         self.stat_fmodify = 0
+        # modified directories waiting for push_tree_files()
+        self.pushdirs = array.array('l')
+        # rows of multi-row statements by kind and their total count
+        self.batch = {}
+        self.batched = 0
+        self.vectorizer = TsVectorizer(cursor) if client_tsvector else None
+        self.pinsert = pquery_insert_tsvector if client_tsvector else pquery_insert
+        if files_names_table:
+            self.names = names_resolver()
+            self.finsert = fquery_append_names
+            self.fvalues = fquery_values_names
+        else:
+            self.names = None
+            self.finsert = fquery_append
+            self.fvalues = fquery_values_tsvector if client_tsvector else fquery_values
+    def name(self, vars):
+        """ fills value of tsname or name_id column of file with name vars['n'] """
+        if self.names is not None:
+            vars['nid'] = self.names.id(vars['n'])
+        else:
+            vars['r'] = self.tsdocument(vars['n'])
+        return vars
+    def tsdocument(self, string):
+        """ returns value for tsname and tspath columns """
+        relax = tsprepare(string)
+        if self.vectorizer is not None:
+            return self.vectorizer.tsvector(relax)
+        return relax
     def append(self, q, vars):
         self.query.append(self.cursor.mogrify(q, vars))
-        if len(self.query) > 1024:
+        if len(self.query) + self.batched > 1024:
             self.commit()
+    def bappend(self, kind, vars):
+        """ adds row to the multi-row statement of given kind. Rows are
+        keyed by tree, path and file, so they don't depend on the order
+        of inserts and are kept by kind until commit """
+        self.batch.setdefault(kind, []).append(self.cursor.mogrify(batch_queries[kind][1], vars))
+        self.batched += 1
+        if len(self.query) + self.batched > 1024:
+            self.commit()
+    def pushappend(self, q, vars):
+        """ adds call of push_path_files() or push_tree_files(), they
+        renumber files and must follow the rows keyed by old numbers """
+        self.bcommit()
+        self.append(q, vars)
+    def bcommit(self):
+        for kind in sorted(self.batch.keys()):
+            self.query.append(batch_queries[kind][0] % string.join(self.batch[kind], ","))
+        self.batch = {}
+        self.batched = 0
     def commit(self):
+        self.bcommit()
         if len(self.query) > 0:
+            if self.names is not None:
+                self.names.resolve(self.vectorizer)
             self.cursor.execute(string.join(self.query, ";"))
             self.query = []
     def fappend(self, vars):
-        self.fquery.append(self.cursor.mogrify(fquery_values, vars))
+        self.fquery.append(self.cursor.mogrify(self.fvalues, vars))
         if len(self.fquery) > 1024:
             self.fcommit()
     def fcommit(self):
         if len(self.fquery) > 0:
-            self.query.append((fquery_append % '') + string.join(self.fquery, ","))
+            self.query.append((self.finsert % '') + string.join(self.fquery, ","))
             self.fquery = []
         self.commit()
     def allcommit(self):
         self.fcommit()
 
-class PathInfo:
-    def __init__(self):
-        self.tspath = ""
-        self.modify = False
+def copy_escape(value):
+    """ escapes text value for COPY text format """
+    if value is None:
+        return "\\N"
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
 
-no_path = PathInfo()
+class CopyBuffer:
+    """ rows buffer for COPY ... FROM STDIN """
+    def __init__(self, cursor, table, columns):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.buf = cStringIO.StringIO()
+        self.rows = 0
+        self.total = 0
+    def append(self, row):
+        self.buf.write(string.join([copy_escape(x) for x in row], "\t") + "\n")
+        self.rows += 1
+        self.total += 1
+        if self.rows >= copy_buffer_rows:
+            self.commit()
+    def commit(self):
+        if self.rows > 0:
+            self.buf.seek(0)
+            self.cursor.copy_from(self.buf, self.table, columns = self.columns)
+            self.buf = cStringIO.StringIO()
+            self.rows = 0
 
-def unicodize_line(line):
-    try:
-        line = unicode(line, scanners_locale)
-    except:
-        log("Non utf-8 line occured: '%s'.", line)
-        line = string.join([(lambda x: x if x in string.printable else "\\%#x" % ord(c))(c) for c in line], "")
-    return line
+class CopyLoader:
+    """ loads full share contents into staging tables with COPY,
+    then moves them to paths and files with set-based statements """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.totalsize = -1
+        cursor.execute("""
+            CREATE TEMPORARY TABLE pathstage (
+                treepath_id integer,
+                path text,
+                tspath text
+                ) ON COMMIT DROP;
+            CREATE TEMPORARY TABLE filestage (
+                treepath_id integer,
+                pathfile_id integer,
+                treedir_id integer,
+                size bigint,
+                items integer,
+                name text,
+                type filetype,
+                tsname text
+                ) ON COMMIT DROP;
+            """)
+        self.paths = CopyBuffer(cursor, 'pathstage',
+            ('treepath_id', 'path', 'tspath'))
+        self.files = CopyBuffer(cursor, 'filestage',
+            ('treepath_id', 'pathfile_id', 'treedir_id', 'size', 'items',
+             'name', 'type', 'tsname'))
+        # with client-side tsvectors rows wait for lexemes in pending
+        self.vectorizer = TsVectorizer(cursor) if client_tsvector else None
+        self.pending = []
+        self.names = names_resolver() if files_names_table else None
+    def append(self, buffer, row):
+        if self.vectorizer is None:
+            buffer.append(row)
+            return
+        self.vectorizer.want(row[-1])
+        self.pending.append((buffer, row))
+        if len(self.pending) >= copy_buffer_rows:
+            self.flush()
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.vectorizer.resolve()
+        for buffer, row in self.pending:
+            buffer.append(row[:-1] + (self.vectorizer.tsvector(row[-1]),))
+        self.pending = []
+    def path(self, id, path):
+        self.append(self.paths, (id, path, tsprepare(path)))
+    def file(self, path, file, size, dirid, items, name):
+        if path == 0:
+            # share root, it goes to staging only for paths table
+            self.totalsize = size
+        type = filetypes_reverse.get(suffix(name)) if dirid == 0 else 'dir'
+        if self.names is None:
+            self.append(self.files, (path, file, dirid, size, items, name, type,
+                                     tsprepare(name)))
+            return
+        # names are inserted to names table before the rows are moved to files
+        self.files.append((path, file, dirid, size, items, name, type, None))
+        self.names.id(name)
+        if len(self.names.wanted) >= copy_buffer_rows:
+            self.names.resolve(self.vectorizer)
+    def commit(self, tree):
+        if self.vectorizer is not None:
+            self.flush()
+            tsname, tspath = "f.tsname::tsvector", "p.tspath::tsvector"
+        else:
+            tsname, tspath = "to_tsvector('uguu', f.tsname)", "to_tsvector('uguu', p.tspath)"
+        columns, join = "tsname", ""
+        if self.names is not None:
+            self.names.resolve(self.vectorizer)
+            columns, tsname, join = "name_id", "n.name_id", " LEFT JOIN names AS n ON n.name = f.name"
+        self.paths.commit()
+        self.files.commit()
+        self.cursor.execute("""
+            INSERT INTO paths (tree_id, treepath_id, parent_id, parentfile_id, path, items, size, tspath)
+            SELECT %%(t)s, p.treepath_id, d.treepath_id, d.pathfile_id, p.path,
+                coalesce(d.items, 0), coalesce(d.size, 0), %s
+            FROM pathstage AS p
+            LEFT JOIN filestage AS d ON d.treedir_id = p.treepath_id;
+            INSERT INTO files (tree_id, treepath_id, pathfile_id, treedir_id, size, name, type, %s)
+            SELECT %%(t)s, f.treepath_id, f.pathfile_id, f.treedir_id, f.size, f.name, f.type, %s
+            FROM filestage AS f%s
+            WHERE f.treepath_id > 0;
+            """ % (tspath, columns, tsname, join), {'t': tree})
 
 def scan_line_patch(cursor, tree, line, qcache, paths_buffer):
-    line = unicodize_line(line)
-    if line[2] == "0":
-        # 'path' type of line 
-        try:
-            act, l, id, path = string.split(s = line, sep = ' ', maxsplit = 3)
-        except:
-            act, l, id = string.split(s = line, sep = ' ', maxsplit = 3)
-            path = ""
-        id = int(id)
+    """ applies line of scanner output, paths_buffer is dtparse.DirTable """
+    rec = dtparse.parse_line(line)
+    if rec[1] == dtparse.PATH:
+        # 'path' type of line
+        act, l, id, path = rec
         if act == '+':
             qcache.stat_padd += 1
-            paths_buffer[id] = PathInfo()
-            paths_buffer[id].tspath = tsprepare(path)
-            qcache.append("INSERT INTO paths (tree_id, treepath_id, path) VALUES (%(t)s, %(id)s, %(p)s)",
-                {'t':tree, 'id':id, 'p':path})
+            paths_buffer.add(id)
+            qcache.append(qcache.pinsert,
+                {'t':tree, 'id':id, 'p':path, 'r':qcache.tsdocument(path)})
         elif act == '-':
             qcache.stat_pdelete += 1
-            qcache.append("DELETE FROM paths WHERE tree_id = %(t)s AND treepath_id = %(id)s",
-                {'t':tree, 'id':id})
+            if patch_batch_statements:
+                qcache.bappend('pdelete', {'t':tree, 'id':id})
+            else:
+                qcache.append("DELETE FROM paths WHERE tree_id = %(t)s AND treepath_id = %(id)s",
+                    {'t':tree, 'id':id})
         elif act == '*':
             qcache.stat_pmodify += 1
-            paths_buffer[id] = PathInfo()
-            paths_buffer[id].modify = True
-            paths_buffer[id].tspath = tsprepare(path)
+            paths_buffer.add(id, True)
     else:
         # 'file' type of line
-        try:
-            act, l, path, file, size, dirid, items, name = string.split(s = line, sep = ' ', maxsplit = 7)
-        except:
-            act, l, path, file, size, dirid, items = string.split(s = line, sep = ' ', maxsplit = 7)
-            name = ""
-        path = int(path)
-        file = int(file)
-        size = int(size)
-        dirid = int(dirid)
-        items = int(items)
+        act, l, path, file, size, dirid, items, name = rec
         if (act == '+' or act == '*') and dirid > 0:
             # if directory then update paths table
-            qcache.append("""
-                UPDATE paths SET parent_id = %(p)s, parentfile_id = %(f)s, items = %(i)s, size = %(sz)s
-                WHERE tree_id = %(t)s AND treepath_id = %(d)s
-                """, {'p':path, 'f':file, 'i':items, 'sz':size, 't':tree, 'd':dirid})
-            if paths_buffer.pop(dirid, no_path).modify:
-                qcache.append("SELECT push_path_files(%(t)s, %(d)s)", {'t': tree, 'd': dirid})
+            if patch_batch_statements:
+                qcache.bappend('pmodify', {'p':path, 'f':file, 'i':items, 'sz':size, 't':tree, 'd':dirid})
+            else:
+                qcache.append("""
+                    UPDATE paths SET parent_id = %(p)s, parentfile_id = %(f)s, items = %(i)s, size = %(sz)s
+                    WHERE tree_id = %(t)s AND treepath_id = %(d)s
+                    """, {'p':path, 'f':file, 'i':items, 'sz':size, 't':tree, 'd':dirid})
+            if paths_buffer.pop(dirid):
+                if push_set_based:
+                    qcache.pushdirs.append(dirid)
+                else:
+                    qcache.pushappend("SELECT push_path_files(%(t)s, %(d)s)", {'t': tree, 'd': dirid})
         if path == 0:
             # if share root then it's size is the share size
             qcache.totalsize = size
@@ -160,141 +547,802 @@ def scan_line_patch(cursor, tree, line, qcache, paths_buffer):
                 suf = suffix(name)
                 type = filetypes_reverse.get(suf) if dirid == 0 else 'dir'
                 qcache.stat_fadd += 1
-                if paths_buffer[path].modify:
-                    qcache.append((fquery_append % 'new') + fquery_values,
-                        {'i':tree, 'p':path, 'f':file, 'did':dirid, 'sz':size,
-                         'n':name, 't':type, 'r':tsprepare(name), 'rt':paths_buffer[path].tspath})
+                vars = qcache.name({'i':tree, 'p':path, 'f':file, 'did':dirid, 'sz':size,
+                                    'n':name, 't':type})
+                if paths_buffer.modified(path):
+                    qcache.append((qcache.finsert % 'new') + qcache.fvalues, vars)
                 else:
-                    qcache.fappend({'i':tree, 'p':path, 'f':file, 'did':dirid, 'sz':size,
-                         'n':name, 't':type, 'r':tsprepare(name), 'rt':paths_buffer[path].tspath})
+                    qcache.fappend(vars)
             elif act == '-':
                 qcache.stat_fdelete += 1
-                qcache.append("""
-                    DELETE FROM files
-                    WHERE tree_id = %(t)s AND treepath_id = %(p)s AND pathfile_id = %(f)s;
-                    """, {'t': tree, 'p': path, 'f': file})
+                if patch_batch_statements:
+                    qcache.bappend('fdelete', {'t': tree, 'p': path, 'f': file})
+                else:
+                    qcache.append("""
+                        DELETE FROM files
+                        WHERE tree_id = %(t)s AND treepath_id = %(p)s AND pathfile_id = %(f)s;
+                        """, {'t': tree, 'p': path, 'f': file})
             elif act == '*':
                 qcache.stat_fmodify += 1
-                qcache.append("""
-                    UPDATE files SET size = %(sz)s
-                    WHERE tree_id = %(t)s AND treepath_id = %(p)s AND pathfile_id = %(f)s
-                    """, {'t': tree, 'p': path, 'f': file, 'sz': size})
+                if patch_batch_statements:
+                    qcache.bappend('fmodify', {'t': tree, 'p': path, 'f': file, 'sz': size})
+                else:
+                    qcache.append("""
+                        UPDATE files SET size = %(sz)s
+                        WHERE tree_id = %(t)s AND treepath_id = %(p)s AND pathfile_id = %(f)s
+                        """, {'t': tree, 'p': path, 'f': file, 'sz': size})
 
-def scan_share(db, share_id, proto, host, port, tree_id, command):
-    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-    cursor = db.cursor()
-    hoststr = sharestr(proto, host, port)
+def scan_line_full(line, loader):
+    rec = dtparse.parse_line(line)
+    if rec[1] == dtparse.PATH:
+        loader.path(rec[2], rec[3])
+    else:
+        loader.file(*rec[2:])
+
+def read_lines(stream):
+    """ yields lines of the pipe as soon as they arrive, unlike file
+    iteration which waits for its read-ahead buffer to be filled """
+    fd = stream.fileno()
+    rest = ''
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        data = rest + data
+        if os.name == 'nt':
+            data = data.replace('\r\n', '\n')
+        lines = data.split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+class ScannerOutput:
+    """ iterates over scanner output lines. In pipelined mode lines are
+    read by a separate thread and passed through a bounded queue """
+    def __init__(self, process, pipelined):
+        self.process = process
+        self.queue = None
+        self.done = False
+        # progress counters for ScannerWatchdog
+        self.lines = 0
+        self.bytes = 0
+        self.blocked = False
+        if pipelined:
+            self.queue = Queue.Queue(pipeline_queue_size)
+            reader = threading.Thread(target = self.read)
+            reader.setDaemon(True)
+            reader.start()
+    def read(self):
+        chunk = []
+        try:
+            for line in read_lines(self.process.stdout):
+                self.lines += 1
+                self.bytes += len(line)
+                chunk.append(line)
+                if len(chunk) >= pipeline_chunk_lines:
+                    # scanner isn't stalled while loader is busy
+                    self.blocked = True
+                    self.queue.put(chunk)
+                    self.blocked = False
+                    chunk = []
+            self.queue.put(chunk)
+        finally:
+            self.queue.put(None)
+    def __iter__(self):
+        if self.queue is None:
+            for line in read_lines(self.process.stdout):
+                self.lines += 1
+                self.bytes += len(line)
+                yield line
+            return
+        while not self.done:
+            chunk = self.queue.get()
+            if chunk is None:
+                self.done = True
+                return
+            for line in chunk:
+                yield line
+    def terminate(self):
+        """ kills scanner, the output ends """
+        if self.process.poll() is None:
+            try:
+                kill_process(self.process)
+            except OSError:
+                # process has just exited
+                pass
+    def kill(self):
+        self.terminate()
+        if self.queue is not None:
+            while not self.done:
+                self.done = self.queue.get() is None
+        self.process.stdout.close()
+        self.process.wait()
+
+class ScannerWatchdog:
+    """ kills scanner which gives no output for scanner_stall_time seconds
+    or runs longer than budget seconds. Progress of the output is checked
+    every scanner_watchdog_interval seconds in a separate thread, reason
+    is set to 'stalled' or 'timeout' if the scanner is killed """
+    def __init__(self, output, budget = None):
+        self.output = output
+        self.budget = budget
+        self.reason = None
+        # output rates in the last interval
+        self.lines_rate = 0.0
+        self.bytes_rate = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    def run(self):
+        start = last = progress = time.time()
+        lines = bytes = 0
+        while True:
+            self.stopped.wait(scanner_watchdog_interval)
+            if self.stopped.isSet():
+                return
+            now = time.time()
+            self.lines_rate = (self.output.lines - lines) / max(now - last, 1e-6)
+            self.bytes_rate = (self.output.bytes - bytes) / max(now - last, 1e-6)
+            if self.output.bytes != bytes or self.output.blocked:
+                progress = now
+            lines, bytes, last = self.output.lines, self.output.bytes, now
+            if now - progress > scanner_stall_time:
+                self.reason = 'stalled'
+            elif self.budget is not None and now - start > self.budget:
+                self.reason = 'timeout'
+            else:
+                continue
+            self.output.terminate()
+            return
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def count_listing_lines(filename):
+    """ returns number of non-patch lines in the saved scanner output """
+    count = 0
+    for line in open_save(filename):
+        if line[0] not in ('+', '-', '*'):
+            count += 1
+    return count
+
+class TimedCursor:
+    """ cursor wrapper counting time spent in the database """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.elapsed = 0.0
+    def execute(self, query, vars = None):
+        start = time.time()
+        try:
+            return self.cursor.execute(query, vars)
+        finally:
+            self.elapsed += time.time() - start
+    def copy_from(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.cursor.copy_from(*args, **kwargs)
+        finally:
+            self.elapsed += time.time() - start
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class ShareLoader:
+    """ applies scanner output to the database line by line.
+    oldhash is the digest of saved contents expected in patch header,
+    None requests non-patching mode. If patch_limit is set, patch longer
+    than patch_limit lines is rolled back and non-patching mode is used """
+    def __init__(self, cursor, tree, oldhash, patch_limit = None):
+        self.cursor = TimedCursor(cursor)
+        self.tree = tree
+        self.oldhash = oldhash
+        self.patch_limit = patch_limit
+        self.patchmode = oldhash is not None
+        self.header = self.patchmode
+        self.patched = False
+        self.loader = None
+        if files_names_table:
+            names_resolver().sync(self.cursor)
+        if not self.patchmode:
+            self.start_full()
+    def start_patch(self):
+        if self.patch_limit is not None:
+            self.cursor.execute("SAVEPOINT patch")
+        self.qcache = PsycoCache(self.cursor)
+        self.paths_buffer = dtparse.DirTable()
+        self.patch_lines = 0
+        self.cursor.execute("""
+            CREATE TEMPORARY TABLE newfiles (
+                LIKE files INCLUDING DEFAULTS
+                ) ON COMMIT DROP;
+            CREATE INDEX newfiles_path ON newfiles(treepath_id);
+            """)
+    def start_full(self):
+        self.patchmode = False
+        self.qcache = PsycoCache(self.cursor)
+        self.paths_buffer = dtparse.DirTable()
+        if full_rescan_rebuild and not bulk_load[0]:
+            # contents are loaded into a new tree which is swapped with
+            # the old one on commit, the old tree is left for purge_trees()
+            self.cursor.execute("INSERT INTO trees (share_id) VALUES (NULL) RETURNING tree_id")
+            self.tree = self.cursor.fetchone()['tree_id']
+        else:
+            # rows are counted for maintain_tables(), in bulk load files
+            # aren't indexed and go by cascade from paths
+            if not bulk_load[0]:
+                self.cursor.execute("DELETE FROM files WHERE tree_id = %(t)s", {'t': self.tree})
+                self.qcache.stat_fdelete = self.cursor.rowcount
+            self.cursor.execute("DELETE FROM paths WHERE tree_id = %(t)s", {'t': self.tree})
+            self.qcache.stat_pdelete = self.cursor.rowcount
+        if spider_copy_loader or bulk_load[0]:
+            self.loader = CopyLoader(self.cursor)
+    def finish_patch(self):
+        self.patched = True
+        dirs = self.qcache.pushdirs.tolist() + self.paths_buffer.modified_dirs()
+        if push_set_based:
+            if len(dirs) > 0:
+                self.qcache.pushappend("SELECT push_tree_files(%(t)s, %(d)s)", {'t': self.tree, 'd': dirs})
+            return
+        for dirid in dirs:
+            self.qcache.pushappend("SELECT push_path_files(%(t)s, %(d)s)", {'t': self.tree, 'd': dirid})
+    def feed(self, line):
+        if self.header:
+            self.header = False
+            if line == "* " + self.oldhash + "\n":
+                self.start_patch()
+                return
+            log("MD5 digest from scanner doesn't match the one from the database. Fallback to non-patching mode.")
+            self.start_full()
+        if line[0] in ('+', '-', '*'):
+            if self.patchmode and not self.patched:
+                self.patch_lines += 1
+                if self.patch_limit is not None and self.patch_lines > self.patch_limit:
+                    log("Patch is too long (more than %s lines). Fallback to non-patching mode", (int(self.patch_limit),))
+                    self.cursor.execute("ROLLBACK TO SAVEPOINT patch")
+                    self.start_full()
+                    return
+                scan_line_patch(self.cursor, self.tree, line, self.qcache, self.paths_buffer)
+            return
+        if self.patchmode:
+            # patch is followed by the full contents, it is only saved
+            if not self.patched:
+                self.finish_patch()
+        elif self.loader is not None:
+            scan_line_full(line, self.loader)
+        else:
+            scan_line_patch(self.cursor, self.tree, "+ " + line, self.qcache, self.paths_buffer)
+    def finish(self):
+        """ flushes all pending changes, returns PsycoCache with statistics """
+        if self.header:
+            self.header = False
+            log("MD5 digest from scanner doesn't match the one from the database. Fallback to non-patching mode.")
+            self.start_full()
+        if self.patchmode and not self.patched:
+            self.finish_patch()
+        if self.loader is not None:
+            self.loader.commit(self.tree)
+            self.qcache.totalsize = self.loader.totalsize
+            self.qcache.stat_padd = self.loader.paths.total
+            # share root is not stored in files
+            self.qcache.stat_fadd = max(self.loader.files.total - 1, 0)
+        self.qcache.allcommit()
+        return self.qcache
+
+def reset_peak_rss():
+    """ starts measuring peak resident set size anew (Linux 4.0+) """
     try:
-        # asquire lock on the column from trees table
-        cursor.execute("SELECT hash FROM ONLY trees WHERE tree_id=%(t)s FOR UPDATE NOWAIT", {'t': tree_id})
-        oldhash = cursor.fetchone()['hash']
+        file = open("/proc/self/clear_refs", "w")
+        file.write("5")
+        file.close()
     except:
-        # if other spider instance didn't complete scanning, do nothing
-        # side effect is backing-off the next scan
-        log("Scanning %s is running too long in another spider instance or database error.", (hoststr,))
-        db.rollback()
-        return
+        pass
+
+def peak_rss():
+    """ returns peak resident set size of spider in kilobytes """
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except:
+        return 0
+
+def seconds(delta):
+    """ returns timedelta in seconds """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+def schedule_next_scan(changes, elapsed, rate, duration, scan_time):
+    """ updates averages of share's change rate (changes per hour) and scan
+    duration (seconds) with observed number of changes for elapsed seconds
+    since the previous scan and scan time. Returns (rate, duration, hours
+    until the next scan) """
+    if duration is None:
+        duration = scan_time
+    else:
+        duration += scan_average_weight * (scan_time - duration)
+    if changes is not None and elapsed is not None and elapsed > 0:
+        observed = changes * 3600.0 / elapsed
+        if rate is None:
+            rate = observed
+        else:
+            rate += scan_average_weight * (observed - rate)
+    if rate is None:
+        # nothing is known yet
+        hours = scan_interval_min
+    elif rate > 0:
+        hours = scan_target_changes / rate
+    else:
+        hours = scan_interval_max
+    hours = max(hours, scan_interval_min, duration * scan_duration_factor / 3600.0)
+    return rate, duration, min(hours, scan_interval_max)
+
+class ScanRecord:
+    """ metrics of a scan saved to scan_history table """
+    def __init__(self, share_id):
+        self.share_id = share_id
+        self.start = time.time()
+        self.mode = None
+        self.lines = 0
+        self.bytes = 0
+        self.scanner_time = None
+        self.parse_time = None
+        self.db_time = None
+        self.rows_added = None
+        self.rows_deleted = None
+        self.rows_modified = None
+        self.peak_memory = None
+        self.patch_lines = None
+        self.listing_lines = None
+        self.modified_dirs = None
+        self.pushed_files = None
+    def save(self, cursor, outcome):
+        if not keep_scan_history:
+            return
+        vars = dict(self.__dict__)
+        vars['outcome'] = outcome
+        vars['elapsed'] = time.time() - self.start
+        cursor.execute("""
+            INSERT INTO scan_history (share_id, started, mode, outcome, lines, bytes,
+                scanner_time, parse_time, db_time,
+                rows_added, rows_deleted, rows_modified, peak_memory,
+                patch_lines, listing_lines, modified_dirs, pushed_files)
+            VALUES (%(share_id)s, clock_timestamp() - %(elapsed)s * interval '1 second',
+                %(mode)s, %(outcome)s, %(lines)s, %(bytes)s,
+                %(scanner_time)s, %(parse_time)s, %(db_time)s,
+                %(rows_added)s, %(rows_deleted)s, %(rows_modified)s, %(peak_memory)s,
+                %(patch_lines)s, %(listing_lines)s, %(modified_dirs)s, %(pushed_files)s)
+            """, vars)
+
+class PatchStats:
+    """ counts features of scanner output the cost of update depends on:
+    lines of the patch and of the listing, directories modified by the
+    patch and listing lines of their files, which are renumbered by
+    push_tree_files. Patch lines go before the listing in scanner output """
+    def __init__(self):
+        self.lines = 0
+        self.patch = 0
+        self.pushed = 0
+        self.modified = set()
+    def count(self, line):
+        self.lines += 1
+        if line[0] in ('+', '-', '*'):
+            self.patch += 1
+            if line[:4] == "* 0 ":
+                self.modified.add(line[4:line.find(' ', 4)])
+        elif self.modified and line[0] == '1' and line[2:line.find(' ', 2)] in self.modified:
+            self.pushed += 1
+    def features(self):
+        return {'patch_lines': self.patch, 'listing_lines': self.lines - self.patch,
+                'modified_dirs': len(self.modified), 'pushed_files': self.pushed}
+
+# cost model shared by scans of the process and time it was fitted
+fitted_model = [None, 0]
+
+def current_cost_model(cursor):
+    """ returns cost model refitted every cost_model_refresh seconds,
+    None if there is not enough history to fit it """
+    if not cost_model or not keep_scan_history:
+        return None
+    if time.time() - fitted_model[1] > cost_model_refresh:
+        fitted_model[1] = time.time()
+        try:
+            fitted_model[0] = costmodel.fit(cursor)
+        except:
+            log("Failed to fit cost model.")
+            traceback.print_exc()
+            fitted_model[0] = None
+    return fitted_model[0]
+
+def patch_too_costly(model, stats, hoststr):
+    """ tells whether loading the whole contents is cheaper than the patch """
+    features = stats.features()
+    if model is None:
+        if stats.patch > features['listing_lines'] / patch_fallback:
+            log("Patch is too long for %s (patch %s, non-patch %s). Fallback to non-patching mode",
+                (hoststr, stats.patch, features['listing_lines']))
+            return True
+        return False
+    patch = model.predict('patch', features)
+    full = model.predict('full', features)
+    if full < patch:
+        log("Patch is expected to be slower for %s (%.1f s, non-patch %.1f s). Fallback to non-patching mode",
+            (hoststr, patch, full))
+        return True
+    return False
+
+def lease_owner():
+    """ identifies this spider process in leases """
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+def lease_held(cursor, share_id):
+    """ extends the lease if it is still ours, the share row stays locked
+    until the end of transaction, so the lease can't be lost afterwards """
+    cursor.execute("""
+        UPDATE shares SET lease_expires = now() + %(l)s * interval '1 second'
+        WHERE share_id = %(s)s AND lease_owner = %(o)s
+        """, {'s': share_id, 'o': lease_owner(), 'l': lease_time})
+    return cursor.rowcount == 1
+
+def release_lease(db, share_id):
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    db.cursor().execute("""
+        UPDATE shares SET lease_owner = NULL, lease_expires = NULL
+        WHERE share_id = %%(s)s AND lease_owner = %%(o)s;
+        NOTIFY %s;
+        """ % shares_channel, {'s': share_id, 'o': lease_owner()})
+
+class LeaseHeartbeat:
+    """ extends lease of the share being scanned every lease_heartbeat
+    seconds. Runs in a separate thread with its own connection, so
+    the lease is kept while scanner runs outside of any transaction """
+    def __init__(self):
+        self.share_id = None
+        self.lost = False
+        self.db = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    def hold(self, share_id):
+        self.lost = False
+        self.share_id = share_id
+    def release(self):
+        self.share_id = None
+    def beat(self, share_id):
+        if self.db is None:
+            self.db = connectdb("spider")
+            self.db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.db.cursor()
+        cursor.execute("""
+            UPDATE shares SET lease_expires = now() + %(l)s * interval '1 second'
+            WHERE share_id = %(s)s AND lease_owner = %(o)s
+            """, {'s': share_id, 'o': lease_owner(), 'l': lease_time})
+        # the beat may wait for the row locked by the load and find the
+        # lease released by it, the share isn't held at that time
+        if cursor.rowcount != 1 and self.share_id == share_id and not self.lost:
+            self.lost = True
+            log("Lease of share %s is lost.", (share_id,))
+    def run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(lease_heartbeat)
+            share_id = self.share_id
+            if share_id is None or self.stopped.isSet():
+                continue
+            try:
+                self.beat(share_id)
+            except:
+                # reconnect on the next beat
+                log("Failed to extend lease of share %s.", (share_id,))
+                self.db = None
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.db is not None:
+            self.db.close()
+
+def replay_listing(path):
+    """ returns process printing saved listing as scanner would do """
+    _preexec = None
+    if os.name == 'posix':
+        _preexec = os.setsid
+    return subprocess.Popen([sys.executable, "-c",
+        "import sys, shutil, common; shutil.copyfileobj(common.open_save(sys.argv[1]), sys.stdout)",
+        os.path.abspath(path)], stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+        cwd = os.path.dirname(os.path.abspath(__file__)), preexec_fn = _preexec)
+
+def scan_share(db, share_id, proto, host, port, tree_id, command, record = None, replay = None,
+               heartbeat = None):
+    """ scans share and updates database, returns number of lines got
+    from scanner or None if the share wasn't scanned successfully.
+    The share should be leased by claim_share. Scanner runs outside of
+    any transaction, the transaction is opened for loading only, unless
+    scan_pipelined is set. Metrics of the scan are collected in record.
+    If replay is set, the listing from this file is loaded instead of
+    running scanner. Heartbeat is released when the lease is checked
+    before commit, the share row is locked from then on """
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db.cursor()
+    # scanners without '-u' give full listing, it is diffed after the scan,
+    # replayed listings are diffed as well
+    pydiff = replay is not None or command.split()[0] in scanners_without_diff
+    pipelined = scan_pipelined and not pydiff
+    hoststr = sharestr(proto, host, port)
+    if record is None:
+        record = ScanRecord(share_id)
+    def save_record(outcome):
+        # used after rollback of the scan's transaction
+        record.peak_memory = peak_rss()
+        record.save(cursor, outcome)
+        db.commit()
+    # tree is looked up by share since it could be swapped by rebuild
+    if pipelined:
+        # database is updated while scanner is running, so the
+        # transaction and the lock are held for the whole scan
+        db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        try:
+            cursor.execute("SELECT tree_id, hash FROM ONLY trees WHERE share_id=%(s)s FOR UPDATE NOWAIT", {'s': share_id})
+            tree_id, oldhash = cursor.fetchone()
+        except:
+            log("Tree of %s is locked by another spider instance or database error.", (hoststr,))
+            db.rollback()
+            save_record('busy')
+            return None
+    else:
+        cursor.execute("SELECT tree_id, hash FROM ONLY trees WHERE share_id=%(s)s", {'s': share_id})
+        tree_id, oldhash = cursor.fetchone()
+    cursor.execute("""
+        SELECT extract(epoch FROM now() - last_scan)::float8, change_rate, scan_duration
+        FROM shares WHERE share_id = %(s)s
+        """, {'s': share_id})
+    elapsed, rate, duration = cursor.fetchone()
     savepath = share_save_path(proto, host, port)
-    patchmode = oldhash != None and os.path.isfile(savepath)
+    oldpath = share_save_find(proto, host, port)
+    # bulk load goes without patches, they need indexes of files
+    patchmode = oldhash != None and oldpath is not None and not bulk_load[0]
     try:
-        address = socket.gethostbyname(host)
+        address = host if replay is not None else socket.gethostbyname(host)
     except:
         log("Name resolution failed for %s.", (hoststr,))
         db.rollback()
-        return
+        save_record('unresolved')
+        return None
     log("Scanning %s (%s) ...", (hoststr, address))
+    reset_peak_rss()
     start = datetime.datetime.now()
-    if patchmode:
-        data = run_scanner(command, address, proto, port, "-u " + quote_for_shell(savepath))
+    loader = None
+    if pipelined:
+        if patchmode:
+            loader = ShareLoader(cursor, tree_id, oldhash,
+                count_listing_lines(oldpath) / patch_fallback)
+        else:
+            loader = ShareLoader(cursor, tree_id, None)
+    if patchmode and not pydiff:
+        saveinput = SaveInput(oldpath)
+        data = run_scanner(command, address, proto, port, "-u " + quote_for_shell(saveinput.path))
+    elif replay is not None:
+        saveinput = None
+        data = replay_listing(replay)
     else:
+        saveinput = None
         data = run_scanner(command, address, proto, port)
-    save = tempfile.TemporaryFile(bufsize = -1)
-    line_count = 0
-    line_count_patch = 0
+    output = ScannerOutput(data, pipelined)
+    watchdog = ScannerWatchdog(output, scanner_time_budget.get(proto))
+    # output is saved and hashed in a single pass, the new save
+    # replaces the old one after successful update of the database
+    newpath = savepath + ".new"
+    create_save_subdir(newpath)
+    if pydiff and patchmode:
+        listing = tempfile.TemporaryFile(dir = os.path.dirname(newpath))
+        save = listing
+    else:
+        listing = None
+        save = open_save(newpath, "wb")
+    def discard_save():
+        save.close()
+        if listing is None:
+            os.unlink(newpath)
+        if saveinput is not None:
+            saveinput.close()
+    stats = PatchStats()
+    line_bytes = 0
     hash = hashlib.md5()
-    for line in data.stdout:
-        line_count += 1
-        if line[0] in ('+', '-', '*'):
-            line_count_patch += 1
-        if line_count > max_lines_from_scanner:
-            kill_process(data)
-            data.stdout.close()
-            data.wait()
-            log("Scanning %s failed. Too many lines from scanner (elapsed time %s).", (hoststr, datetime.datetime.now() - start))
-            db.rollback()
-            return
-        hash.update(line)
-        save.write(line)
-    if data.wait() != 0:
+    # time spent by loader while scanner is running
+    loading = 0.0
+    try:
+        for line in output:
+            stats.count(line)
+            line_bytes += len(line)
+            if stats.lines > max_lines_from_scanner:
+                output.kill()
+                discard_save()
+                log("Scanning %s failed. Too many lines from scanner (elapsed time %s).", (hoststr, datetime.datetime.now() - start))
+                db.rollback()
+                record.lines, record.bytes = stats.lines, line_bytes
+                save_record('toolong')
+                return None
+            hash.update(line)
+            save.write(line)
+            if loader is not None:
+                fed = time.time()
+                loader.feed(line)
+                loading += time.time() - fed
+    except:
+        output.kill()
+        discard_save()
+        raise
+    finally:
+        watchdog.stop()
+    if data.wait() != 0 and watchdog.reason is not None:
+        discard_save()
+        db.rollback()
+        # scanner was killed, the host is likely to respond later
         cursor.execute("""
-            UPDATE shares SET next_scan = now() + %(w)s
+            UPDATE shares SET failed_scans = failed_scans + 1, next_scan = now() + %(w)s
             WHERE share_id = %(s)s;
-            """, {'s': share_id, 'w': wait_until_next_scan_failed})
+            """, {'s': share_id, 'w': wait_until_next_scan_killed})
+        log("Scanning %s was killed by watchdog: %s after %s lines (elapsed time %s, last rate %.1f lines/s).",
+            (hoststr, watchdog.reason, stats.lines, datetime.datetime.now() - start, watchdog.lines_rate))
+        record.lines, record.bytes = stats.lines, line_bytes
+        record.scanner_time = seconds(datetime.datetime.now() - start) - loading
+        save_record(watchdog.reason)
+        return None
+    if data.returncode != 0:
+        discard_save()
+        # drop everything loaded in pipelined mode
+        db.rollback()
+        if adaptive_scheduling:
+            # exponential backoff for repeatedly failing shares
+            cursor.execute("""
+                UPDATE shares SET failed_scans = failed_scans + 1,
+                    next_scan = now() + least(%(w)s::interval * power(2, least(failed_scans, 16)),
+                                              %(m)s * interval '1 hour')
+                WHERE share_id = %(s)s;
+                """, {'s': share_id, 'w': wait_until_next_scan_failed, 'm': scan_failed_max})
+        else:
+            cursor.execute("""
+                UPDATE shares SET next_scan = now() + %(w)s
+                WHERE share_id = %(s)s;
+                """, {'s': share_id, 'w': wait_until_next_scan_failed})
         log("Scanning %s failed with return code %s (elapsed time %s).", (hoststr, data.returncode, datetime.datetime.now() - start))
-        db.commit()
-        return
-    if patchmode and (line_count_patch > (line_count - line_count_patch) / patch_fallback):
-        log("Patch is too long for %s (patch %s, non-patch %s). Fallback to non-patching mode", (hoststr, line_count_patch, line_count - line_count_patch))
-        patchmode = False
+        record.lines, record.bytes = stats.lines, line_bytes
+        record.scanner_time = seconds(datetime.datetime.now() - start) - loading
+        save_record('failed')
+        return None
+    if saveinput is not None:
+        saveinput.close()
+    if listing is not None:
+        # make the patch as scanner would do with '-u'
+        old = treediff.open_listing(oldpath)
+        new = treediff.Listing(listing)
+        save = open_save(newpath, "wb")
+        hash = hashlib.md5()
+        stats = PatchStats()
+        for line in treediff.diff(old, new):
+            stats.count(line)
+            hash.update(line)
+            save.write(line)
+        old.close()
+        new.close()
+    save.close()
     scan_time = datetime.datetime.now() - start
     start = datetime.datetime.now()
-    qcache = PsycoCache(cursor)
-    paths_buffer = dict()
-    save.seek(0)
-    if patchmode and (oldhash == None or save.readline() != "* " + oldhash + "\n"):
-        save.seek(0)
-        patchmode = False
-        log("MD5 digest from scanner doesn't match the one from the database. Fallback to non-patching mode.")
-    if patchmode:
-        cursor.execute("""
-            CREATE TEMPORARY TABLE newfiles (
-                LIKE files INCLUDING DEFAULTS
-                ) ON COMMIT DROP;
-            CREATE INDEX newfiles_path ON newfiles(treepath_id);
-            """)
+    record.scanner_time = seconds(scan_time) - loading
+    if loader is None:
+        # model is fitted before the tree is locked
+        model = current_cost_model(cursor) if patchmode else None
+        # scanning is done, open the transaction for loading
+        db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        cursor.execute("SELECT hash FROM ONLY trees WHERE tree_id = %(t)s AND share_id = %(s)s FOR UPDATE",
+            {'s': share_id, 't': tree_id})
+        row = cursor.fetchone()
+        if heartbeat is not None:
+            heartbeat.release()
+        if row is None or row[0] != oldhash or not lease_held(cursor, share_id):
+            os.unlink(newpath)
+            log("Lease of %s was lost while scanning, contents are discarded (elapsed time %s).", (hoststr, scan_time))
+            db.rollback()
+            record.lines, record.bytes = stats.lines, line_bytes
+            save_record('leaselost')
+            return None
+        if patchmode and patch_too_costly(model, stats, hoststr):
+            patchmode = False
+        loader = ShareLoader(cursor, tree_id, oldhash if patchmode else None)
+        save = open_save(newpath)
         for line in save:
-            if line[0] not in ('+', '-', '*'):
-                break
-            scan_line_patch(cursor, tree_id, line.strip('\n'), qcache, paths_buffer)
-        for (dirid, pinfo) in paths_buffer.iteritems():
-            if pinfo.modify:
-                qcache.append("SELECT push_path_files(%(t)s, %(d)s)", {'t': tree_id, 'd': dirid})
+            loader.feed(line)
+        save.close()
+    qcache = loader.finish()
+    loading += seconds(datetime.datetime.now() - start)
+    record.mode = 'patch' if loader.patchmode else 'full'
+    record.lines, record.bytes = stats.lines, line_bytes
+    features = stats.features()
+    record.patch_lines, record.listing_lines = features['patch_lines'], features['listing_lines']
+    record.modified_dirs, record.pushed_files = features['modified_dirs'], features['pushed_files']
+    record.db_time = loader.cursor.elapsed
+    record.parse_time = loading - record.db_time
+    record.rows_added = qcache.stat_padd + qcache.stat_fadd
+    record.rows_deleted = qcache.stat_pdelete + qcache.stat_fdelete
+    record.rows_modified = qcache.stat_pmodify + qcache.stat_fmodify
+    if loader.patchmode:
+        changes = qcache.stat_fadd + qcache.stat_fdelete + qcache.stat_fmodify
+    elif patchmode:
+        # patch was too long, at least its length is known
+        changes = stats.patch
     else:
-        cursor.execute("DELETE FROM paths WHERE tree_id = %(t)s", {'t':tree_id})
-        for line in save:
-            if line[0] in ('+', '-', '*'):
-                continue
-            scan_line_patch(cursor, tree_id, "+ " + line.strip('\n'), qcache, paths_buffer)
-    qcache.allcommit()
+        changes = None
+    patchmode = loader.patchmode
+    if pipelined and heartbeat is not None:
+        heartbeat.release()
+    if pipelined and not lease_held(cursor, share_id):
+        os.unlink(newpath)
+        log("Lease of %s was lost while scanning, contents are discarded (elapsed time %s).", (hoststr, scan_time))
+        db.rollback()
+        save_record('leaselost')
+        return None
     try:
-        if os.path.isfile(savepath):
-            shutil.move(savepath, savepath + ".old")
-        save.seek(0)
-        file = open(savepath, 'wb')
-        shutil.copyfileobj(save, file)
-        file.close()
+        if oldpath is not None:
+            shutil.move(oldpath, savepath + ".old")
+        os.rename(newpath, savepath)
     except:
         log("Failed to save contents of %s to file %s.", (hoststr, savepath))
         traceback.print_exc()
-    save.close()
+    if loader.tree != tree_id:
+        # swap rebuilt tree in, old tree's contents are purged later
+        cursor.execute("""
+            UPDATE trees SET share_id = NULL WHERE tree_id = %(o)s;
+            UPDATE trees SET share_id = %(s)s WHERE tree_id = %(t)s;
+            UPDATE shares SET tree_id = %(t)s WHERE share_id = %(s)s;
+            """, {'s': share_id, 'o': tree_id, 't': loader.tree})
+        tree_id = loader.tree
+    if adaptive_scheduling:
+        rate, duration, hours = schedule_next_scan(changes, elapsed, rate, duration,
+            seconds(scan_time + (datetime.datetime.now() - start)))
+        cursor.execute("""
+            UPDATE shares SET last_scan = now(), next_scan = now() + %(h)s * interval '1 hour',
+                change_rate = %(r)s, scan_duration = %(d)s, failed_scans = 0,
+                lease_owner = NULL, lease_expires = NULL
+            WHERE share_id = %(s)s;
+            """, {'s': share_id, 'h': hours, 'r': rate, 'd': duration})
+    else:
+        cursor.execute("""
+            UPDATE shares SET last_scan = now(), next_scan = now() + %(w)s,
+                lease_owner = NULL, lease_expires = NULL
+            WHERE share_id = %(s)s;
+            """, {'s': share_id, 'w': wait_until_next_scan})
     cursor.execute("""
-        UPDATE shares SET last_scan = now(), next_scan = now() + %(w)s WHERE share_id = %(s)s;
         UPDATE trees SET hash = %(h)s WHERE tree_id = %(t)s;
-        """, {'s': share_id, 't': tree_id, 'h': hash.hexdigest(), 'w': wait_until_next_scan})
+        """, {'t': tree_id, 'h': hash.hexdigest()})
     if qcache.totalsize >= 0:
         cursor.execute("""
             UPDATE shares SET size = %(sz)s WHERE share_id = %(s)s;
             """, {'s':share_id, 'sz': qcache.totalsize})
+    if record.scanner_time > 0:
+        # expected output rate of scanner for scan_bandwidth_limit
+        cursor.execute("""
+            UPDATE shares SET scan_bandwidth = coalesce((1 - %(w)s) * scan_bandwidth + %(w)s * %(b)s, %(b)s)
+            WHERE share_id = %(s)s;
+            """, {'s': share_id, 'w': scan_average_weight, 'b': line_bytes / record.scanner_time})
+    count_table_changes(cursor, 'paths', qcache.stat_padd, qcache.stat_pdelete, qcache.stat_pmodify)
+    count_table_changes(cursor, 'files', qcache.stat_fadd, qcache.stat_fdelete, qcache.stat_fmodify)
+    record.peak_memory = peak_rss()
+    record.save(cursor, 'success')
     db.commit()
     if patchmode:
         deleted = qcache.stat_pdelete + qcache.stat_fdelete
         added = qcache.stat_padd + qcache.stat_fadd
         modified = qcache.stat_fmodify
-        log("Scanning %s succeded. Database updated in patching mode: delete %s, add %s, modify %s (scan time %s, update time %s).",
-            (hoststr, str(deleted), str(added), str(modified), scan_time, datetime.datetime.now() - start))
+        log("Scanning %s succeded. Database updated in patching mode: delete %s, add %s, modify %s (scan time %s, update time %s, peak memory %s kB).",
+            (hoststr, str(deleted), str(added), str(modified), scan_time, datetime.datetime.now() - start, peak_rss()))
     else:
-        log("Scanning %s succeded. Database updated in non-patching mode (scan time %s, update time %s).",
-            (hoststr, scan_time, datetime.datetime.now() - start))
+        log("Scanning %s succeded. Database updated in non-patching mode (scan time %s, update time %s, peak memory %s kB).",
+            (hoststr, scan_time, datetime.datetime.now() - start, peak_rss()))
+    return stats.lines
 
 def create_save_dir():
      if os.path.isdir(shares_save_dir):
@@ -304,51 +1352,660 @@ def create_save_dir():
      log("%s directory doesn't exist, creating" % (shares_save_dir,))
      os.mkdir(shares_save_dir)
 
-if __name__ == "__main__":
+def create_save_subdir(path):
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        try:
+            os.mkdir(dir)
+        except OSError:
+            # created by other spider
+            pass
+
+def collect_saves():
+    """ removes saves of previous scans older than shares_save_old_days
+    and saves left after failures older than shares_save_failed_days """
+    now = time.time()
+    removed = 0
+    for dir, dirnames, filenames in os.walk(shares_save_dir):
+        for name in filenames:
+            if name.endswith(".old"):
+                days = shares_save_old_days
+            elif name.endswith(".new") or re.search(r'\.\d+$', name):
+                days = shares_save_failed_days
+            else:
+                continue
+            path = os.path.join(dir, name)
+            try:
+                if os.path.getmtime(path) < now - days * 86400:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+    if removed > 0:
+        log("Removed %s expired saves.", (removed,))
+
+def concurrency_conditions():
+    """ returns conditions on share s of claim_share query checking it
+    against shares being scanned by all spiders (CTE running) """
+    conditions = []
+    if max_scans_per_host is not None:
+        conditions.append("(SELECT count(*) FROM running WHERE hostname = s.hostname) < %(lh)s")
+    if max_scans_per_network is not None:
+        conditions.append("(SELECT count(*) FROM running WHERE network = s.network) < %(ln)s")
+    if [l for l in max_scans_per_protocol.values() if l is not None]:
+        conditions.append("""(SELECT count(*) FROM running WHERE protocol = s.protocol) <
+                coalesce((SELECT l FROM unnest(%(pp)s::text[], %(pl)s::integer[]) AS t(p, l)
+                    WHERE p = s.protocol::text), 2147483647)""")
+    if [l for l in scan_bandwidth_limit.values() if l is not None]:
+        conditions.append("""(NOT EXISTS (SELECT 1 FROM running WHERE network = s.network)
+                OR (SELECT sum(coalesce(scan_bandwidth, 0)) FROM running WHERE network = s.network)
+                    + coalesce(s.scan_bandwidth, 0) <=
+                coalesce((SELECT l FROM unnest(%(bn)s::text[], %(bl)s::float8[]) AS t(n, l)
+                    WHERE n = s.network), 'Infinity'))""")
+    return conditions
+
+def claim_share(db):
+    """ atomically leases the oldest share waiting for scan,
+    returns (share_id, tree_id, protocol, hostname, port, scan_command)
+    or None if there are no such shares. Shares with expired leases
+    are left by crashed spiders and are reclaimed at once. Shares
+    exceeding concurrency limits are skipped """
+    cursor = db.cursor()
+    conditions = concurrency_conditions()
+    if conditions:
+        # limits are checked against leases committed by other spiders,
+        # so claims are serialized by the lock held until commit
+        db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        cursor.execute("SELECT pg_advisory_xact_lock(%(k)s, %(j)s)",
+            {'k': claim_lock[0], 'j': claim_lock[1]})
+    else:
+        db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    protocols = [p for p in max_scans_per_protocol if max_scans_per_protocol[p] is not None]
+    networks = [n for n in scan_bandwidth_limit if scan_bandwidth_limit[n] is not None]
+    # shares locked by other spiders are skipped, not waited for
+    cursor.execute("""
+        WITH running AS (
+            SELECT hostname, network, protocol, scan_bandwidth FROM shares
+            WHERE lease_owner IS NOT NULL AND lease_expires >= now()),
+        claim AS (
+            SELECT share_id, lease_owner FROM shares AS s
+            WHERE state = 'online' AND (
+                (lease_owner IS NULL AND (next_scan IS NULL OR next_scan < now()))
+                OR lease_expires < now())%s
+            ORDER BY next_scan NULLS FIRST LIMIT 1
+            FOR UPDATE SKIP LOCKED)
+        UPDATE shares SET next_scan = now() + %%(w)s,
+            lease_owner = %%(o)s, lease_expires = now() + %%(l)s * interval '1 second'
+        FROM scantypes, claim
+        WHERE shares.scantype_id = scantypes.scantype_id
+            AND shares.share_id = claim.share_id
+        RETURNING shares.share_id, tree_id, shares.protocol, hostname, port, scan_command,
+            claim.lease_owner
+        """ % "".join(["\n            AND " + c for c in conditions]),
+        {'w': wait_until_next_scan, 'o': lease_owner(), 'l': lease_time,
+         'lh': max_scans_per_host, 'ln': max_scans_per_network,
+         'pp': protocols, 'pl': [max_scans_per_protocol[p] for p in protocols],
+         'bn': networks, 'bl': [float(scan_bandwidth_limit[n]) for n in networks]})
+    row = cursor.fetchone() if cursor.rowcount == 1 else None
+    if conditions:
+        db.commit()
+    if row is None:
+        return None
+    if row[6] is not None:
+        log("Reclaimed stale lease of %s from %s.", (sharestr(row[2], row[3], row[4]), row[6]))
+    return row[:6]
+
+def save_crash_record(db, record, outcome):
+    try:
+        record.peak_memory = peak_rss()
+        record.save(db.cursor(), outcome)
+        db.commit()
+    except:
+        db.rollback()
+
+def expire_scan_history(db):
+    """ removes records of scans older than scan_history_days """
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    db.cursor().execute("DELETE FROM scan_history WHERE started < now() - %(d)s * interval '1 day'",
+        {'d': scan_history_days})
+
+def process_share(db, share, heartbeat = None, record = None, replay = None):
+    """ scans claimed share handling errors, returns the same as scan_share.
+    Lease of the share is kept by heartbeat and released afterwards """
+    id, tree_id, proto, host, port, command = share
+    if record is None:
+        record = ScanRecord(id)
+    if heartbeat is not None:
+        heartbeat.hold(id)
+    try:
+        return process_share_leased(db, share, record, replay, heartbeat)
+    finally:
+        if heartbeat is not None:
+            heartbeat.release()
+        try:
+            release_lease(db, id)
+        except:
+            log("Failed to release lease of %s, it expires in %s seconds.", (sharestr(proto, host, port), lease_time))
+
+def process_share_leased(db, share, record, replay = None, heartbeat = None):
+    id, tree_id, proto, host, port, command = share
+    try:
+        return scan_share(db, id, proto, host, port, tree_id, command, record, replay, heartbeat)
+    except psycopg2.IntegrityError:
+        now = int(time.time())
+        log("SQL Integrity violation while scanning %s. Rename old contents with suffix %s. Next scan to be in non-patching mode", (sharestr(proto, host, port), now))
+        traceback.print_exc()
+        db.rollback()
+        savepath = share_save_find(proto, host, port)
+        if savepath is not None:
+            shutil.move(savepath, savepath + "." + str(now))
+        savepath = share_save_path(proto, host, port) + ".old"
+        if os.path.isfile(savepath):
+            shutil.move(savepath, savepath + "." + str(now))
+        save_crash_record(db, record, 'integrity')
+    except KeyboardInterrupt:
+        raise
+    except:
+        log("Scanning %s failed with a crash. Something unexpected happened. Exception trace:", sharestr(proto, host, port))
+        traceback.print_exc()
+        db.rollback()
+        save_crash_record(db, record, 'crash')
+    savepath = share_save_path(proto, host, port) + ".new"
+    if os.path.isfile(savepath):
+        os.unlink(savepath)
+    return None
+
+def purge_trees(db):
+    """ deletes trees detached from shares in batches of purge_batch_rows
+    rows sleeping purge_batch_pause seconds between batches """
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db.cursor()
+    cursor.execute("SELECT tree_id FROM trees WHERE share_id IS NULL")
+    for (tree,) in cursor.fetchall():
+        # skip trees being purged by other spider instance
+        cursor.execute("SELECT pg_try_advisory_lock(%(t)s)", {'t': tree})
+        if not cursor.fetchone()[0]:
+            continue
+        start = datetime.datetime.now()
+        rows = 0
+        for table, key in (('files', 'file_id'), ('paths', 'treepath_id')):
+            deleted = 0
+            while True:
+                cursor.execute("""
+                    DELETE FROM %s WHERE tree_id = %%(t)s AND %s IN (
+                        SELECT %s FROM %s WHERE tree_id = %%(t)s LIMIT %%(n)s)
+                    """ % (table, key, key, table),
+                    {'t': tree, 'n': purge_batch_rows})
+                deleted += cursor.rowcount
+                if cursor.rowcount < purge_batch_rows:
+                    break
+                time.sleep(purge_batch_pause)
+            count_table_changes(cursor, table, 0, deleted, 0)
+            rows += deleted
+        cursor.execute("DELETE FROM trees WHERE tree_id = %(t)s AND share_id IS NULL", {'t': tree})
+        cursor.execute("SELECT pg_advisory_unlock(%(t)s)", {'t': tree})
+        log("Purged detached tree %s: %s rows deleted in %s.", (tree, rows, datetime.datetime.now() - start))
+
+# key of advisory lock shared by loads of spiders and taken exclusively
+# by purge_names(), see claim_lock
+names_lock = (1, 2)
+
+def purge_names(db):
+    """ deletes names no file refers to in batches of purge_batch_rows rows
+    sleeping purge_batch_pause seconds between batches. A batch is deleted
+    only while no spider loads a share, the rest is left to the next run
+    otherwise. Every batch advances names_purges, so spiders forget ids of
+    names they remember """
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    cursor = db.cursor()
+    start = datetime.datetime.now()
+    deleted = 0
+    last = 0
+    try:
+        while True:
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%(k)s, %(j)s)",
+                {'k': names_lock[0], 'j': names_lock[1]})
+            if not cursor.fetchone()[0]:
+                break
+            cursor.execute("""
+                DELETE FROM names WHERE name_id IN (
+                    SELECT name_id FROM names AS n
+                    WHERE name_id > %(l)s
+                        AND NOT EXISTS (SELECT 1 FROM files WHERE files.name_id = n.name_id)
+                    ORDER BY name_id LIMIT %(n)s)
+                RETURNING name_id
+                """, {'l': last, 'n': purge_batch_rows})
+            ids = [row[0] for row in cursor.fetchall()]
+            if len(ids) > 0:
+                cursor.execute("SELECT nextval('names_purges')")
+                count_table_changes(cursor, 'names', 0, len(ids), 0)
+            db.commit()
+            deleted += len(ids)
+            if len(ids) < purge_batch_rows:
+                break
+            last = max(ids)
+            time.sleep(purge_batch_pause)
+    finally:
+        db.rollback()
+    if deleted > 0:
+        log("Purged %s names of no files in %s.", (deleted, datetime.datetime.now() - start))
+
+# key of advisory lock held by spider maintaining tables, see claim_lock
+maintenance_lock = (1, 1)
+
+def count_table_changes(cursor, table, added, deleted, modified):
+    """ adds rows changed in table to its counters in table_changes """
+    if not table_maintenance or added + deleted + modified == 0:
+        return
+    cursor.execute("""
+        UPDATE table_changes SET changed = changed + %(c)s, dead = dead + %(d)s
+        WHERE relname = %(t)s
+        """, {'t': table, 'c': added + deleted + modified, 'd': deleted + modified})
+
+def maintain_tables(db, budget = maintenance_time_budget):
+    """ analyzes and vacuums tables with counters in table_changes beyond
+    thresholds. Partitions are processed one by one, the most stale first,
+    until budget seconds are spent, then partitioned table itself is
+    analyzed, autovacuum never does it. Servers before 17 can't analyze
+    it without its partitions, so they are only vacuumed then. Counter of
+    deletions is decreased in proportion to vacuumed partitions, counter
+    of changes is reset when the whole table is analyzed, the rest is
+    left to the next run. Only one spider does it at a time """
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(%(k)s, %(j)s)",
+        {'k': maintenance_lock[0], 'j': maintenance_lock[1]})
+    if not cursor.fetchone()[0]:
+        return
+    start = time.time()
+    try:
+        # rows of partitioned tables are summed over partitions
+        cursor.execute("""
+            SELECT m.relname, m.changed, m.dead,
+                coalesce(sum(greatest(p.reltuples, 0)), 0)::float8 AS reltuples
+            FROM table_changes AS m
+            JOIN pg_class AS t ON t.relname = m.relname AND pg_table_is_visible(t.oid)
+            LEFT JOIN pg_inherits AS i ON i.inhparent = t.oid
+            JOIN pg_class AS p ON p.oid = coalesce(i.inhrelid, t.oid)
+            GROUP BY m.relname, m.changed, m.dead
+            ORDER BY m.relname
+            """)
+        for table, changed, dead, reltuples in cursor.fetchall():
+            analyze = changed > maintenance_analyze_rows + maintenance_analyze_fraction * reltuples
+            vacuum = dead > maintenance_vacuum_rows + maintenance_vacuum_fraction * reltuples
+            if not analyze and not vacuum:
+                continue
+            cursor.execute("""
+                SELECT p.relname, t.relkind = 'p' FROM pg_class AS t
+                LEFT JOIN pg_inherits AS i ON i.inhparent = t.oid
+                JOIN pg_class AS p ON p.oid = coalesce(i.inhrelid, t.oid)
+                LEFT JOIN pg_stat_user_tables AS s ON s.relid = p.oid
+                WHERE t.relname = %%(t)s AND pg_table_is_visible(t.oid)
+                    AND pg_has_role(t.relowner, 'USAGE') AND pg_has_role(p.relowner, 'USAGE')
+                ORDER BY coalesce(s.%s, 0) DESC
+                """ % ("n_dead_tup" if vacuum else "n_mod_since_analyze"), {'t': table})
+            rows = cursor.fetchall()
+            if not rows:
+                log("Table %s needs maintenance, but it is owned by another user.", (table,))
+                continue
+            partitioned = rows[0][1]
+            only = db.server_version >= 170000
+            # (command, relation) in order of execution
+            actions = []
+            if vacuum or not partitioned or only:
+                command = "VACUUM ANALYZE" if vacuum and analyze else "VACUUM" if vacuum else "ANALYZE"
+                if partitioned and not only:
+                    command = "VACUUM"
+                actions = [(command, row[0]) for row in rows]
+            if partitioned and analyze:
+                actions.append(("ANALYZE", "ONLY " + table if only else table))
+            done = 0
+            for command, relation in actions:
+                if time.time() - start > budget:
+                    break
+                begin = time.time()
+                cursor.execute("%s %s" % (command, relation))
+                done += 1
+                log("%s %s took %.1f s (%s rows changed, %s dead in %s).",
+                    (command, relation, time.time() - begin, changed, dead, table))
+            vacuumed = min(done, len(rows)) if vacuum else 0
+            analyzed = analyze and done == len(actions)
+            if vacuumed > 0 or analyzed:
+                cursor.execute("""
+                    UPDATE table_changes SET
+                        changed = greatest(changed - %(c)s, 0), dead = greatest(dead - %(d)s, 0),
+                        last_analyze = CASE WHEN %(a)s THEN now() ELSE last_analyze END,
+                        last_vacuum = CASE WHEN %(v)s THEN now() ELSE last_vacuum END
+                    WHERE relname = %(t)s
+                    """, {'t': table, 'c': changed if analyzed else 0,
+                          'd': dead * vacuumed / len(rows),
+                          'a': analyzed, 'v': vacuumed == len(rows)})
+            if done < len(actions):
+                log("Maintenance budget of %s s is spent, %s of %s actions on %s are left.",
+                    (budget, len(actions) - done, len(actions), table))
+                break
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%(k)s, %(j)s)",
+            {'k': maintenance_lock[0], 'j': maintenance_lock[1]})
+
+class ScanStats:
+    """ aggregates spider throughput """
+    def __init__(self):
+        self.start = time.time()
+        self.last_report = self.start
+        self.shares = 0
+        self.failed = 0
+        self.lines = 0
+    def add(self, lines):
+        self.shares += 1
+        if lines is None:
+            self.failed += 1
+        else:
+            self.lines += lines
+        if time.time() - self.last_report > spider_report_interval:
+            self.log()
+    def log(self):
+        self.last_report = time.time()
+        elapsed = max(time.time() - self.start, 1)
+        log("Processed %s shares (%s failed), %s lines in %s: %.1f shares per hour, %.1f lines per second.",
+            (self.shares, self.failed, self.lines,
+             datetime.timedelta(seconds = int(elapsed)),
+             self.shares * 3600.0 / elapsed, self.lines / elapsed))
+
+# number of SIGTERM and SIGHUP signals got by the process
+stop_signals = [0]
+
+def stop_worker(signum, frame):
+    """ the first signal lets worker finish the current scan,
+    the second one interrupts it """
+    stop_signals[0] += 1
+    if stop_signals[0] > 1:
+        raise KeyboardInterrupt
+    log("Got signal %s, exiting after the current scan.", (signum,))
+
+def count_signal(signum, frame):
+    stop_signals[0] += 1
+
+def handle_signals(handler):
+    signal.signal(signal.SIGTERM, handler)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, handler)
+
+def idle_tasks(db):
+    """ removal of old trees, names, saves and scan records, maintenance of tables """
+    purge_trees(db)
+    if files_names_table:
+        purge_names(db)
+    collect_saves()
+    if keep_scan_history:
+        expire_scan_history(db)
+    if table_maintenance:
+        maintain_tables(db)
+
+def wait_for_shares(db):
+    """ sleeps until the earliest next scan or lease expiration, but at
+    most spider_daemon_sleep seconds. Notification on shares_channel,
+    which should be listened by db, or a signal wake it up earlier.
+    Shares already due are held by concurrency limits or locked by other
+    spiders, they are waited for by notification from the finished scan """
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT extract(epoch FROM min(wake) - now())::float8 FROM (
+            SELECT CASE WHEN lease_owner IS NULL THEN next_scan ELSE lease_expires END AS wake
+            FROM shares WHERE state = 'online') AS s
+        WHERE wake > now()
+        """)
+    due = cursor.fetchone()[0]
+    sleep = spider_daemon_sleep if due is None else min(max(due, 1.0), spider_daemon_sleep)
+    # notifications could come with the query
+    if not db.notifies:
+        try:
+            select.select([db], [], [], sleep)
+        except select.error:
+            # interrupted by signal
+            return
+        db.poll()
+    del db.notifies[:]
+
+def restore_listing(directory, proto, host, port):
+    """ returns path of the share's listing in directory, named as
+    its save (share_save_str, optionally with '.gz'), or None """
+    if directory is None:
+        return None
+    path = os.path.join(directory, share_save_str(proto, host, port))
+    for name in (path, path + ".gz"):
+        if os.path.isfile(name):
+            return name
+    return None
+
+def spider_worker(report, daemon = False, restore = None):
+    """ scans shares until there are no more shares waiting for scan,
+    calls report with scan_share result for each share. In daemon mode
+    waits for shares until stopped by a signal. If restore is set, shares
+    with listings in this directory are loaded from them, see restore_listing.
+    Idle tasks are skipped and commits aren't waited for in bulk load """
     try:
         db = connectdb("spider")
     except:
         log("Unable to connect to the database, exiting.")
-        sys.exit()
-    create_save_dir()
-    shares = db.cursor()
-    while True:
+        return
+    if bulk_load[0]:
+        db.cursor().execute("SET synchronous_commit TO off")
+        db.commit()
+    if daemon:
         db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        shares.execute("""
-            SELECT share_id, tree_id, shares.protocol, hostname, port, scan_command
-            FROM shares
-            LEFT JOIN scantypes USING (scantype_id)
-            WHERE state = 'online' AND (next_scan IS NULL OR next_scan < now())
-            ORDER BY next_scan NULLS FIRST LIMIT 1
-            """)
-        if shares.rowcount == 0:
-            break
-        id, tree_id, proto, host, port, command = shares.fetchone()
-        shares.execute("""
-            UPDATE shares SET next_scan = now() + %(w)s
-            WHERE share_id = %(s)s AND (next_scan IS NULL OR next_scan < now())
-            """, {'s':id, 'w': wait_until_next_scan})
-        if shares.statusmessage != 'UPDATE 1':
+        db.cursor().execute("LISTEN %s" % shares_channel)
+    heartbeat = LeaseHeartbeat()
+    idle = time.time()
+    try:
+        while not stop_signals[0]:
+            share = claim_share(db)
+            if share is not None:
+                report(process_share(db, share, heartbeat, None,
+                                     restore_listing(restore, *share[2:5])))
+                continue
+            if not daemon:
+                break
+            if time.time() - idle > spider_idle_interval and not bulk_load[0]:
+                idle_tasks(db)
+                idle = time.time()
+                continue
+            wait_for_shares(db)
+    finally:
+        heartbeat.stop()
+    # nothing to scan, use idle time for removal of old trees and saves
+    if not stop_signals[0] and not bulk_load[0]:
+        idle_tasks(db)
+    db.close()
+
+def spider_worker_process(queue, daemon, bulk, restore):
+    handle_signals(stop_worker)
+    bulk_load[0] = bulk
+    try:
+        spider_worker(queue.put, daemon, restore)
+    except KeyboardInterrupt:
+        pass
+    queue.put("done")
+
+def run_workers(workers, daemon = False, bulk = False, restore = None):
+    """ runs workers in separate processes, collects their statistics.
+    Signals are passed to workers """
+    stats = ScanStats()
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target = spider_worker_process,
+                                         args = (queue, daemon, bulk, restore))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    handle_signals(count_signal)
+    log("Started %s spider workers.", (workers,))
+    running = workers
+    passed = 0
+    while running > 0:
+        while passed < stop_signals[0]:
+            passed += 1
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+        try:
+            lines = queue.get(timeout = 1)
+            if lines == "done":
+                running -= 1
+            else:
+                stats.add(lines)
+        except Queue.Empty:
+            if len([p for p in processes if p.is_alive()]) == 0:
+                break
+        except IOError:
+            # interrupted by signal
+            pass
+    for process in processes:
+        process.join()
+    stats.log()
+
+def wal_position(cursor):
+    """ returns current WAL position in bytes or None if it is unknown """
+    for function in ("pg_current_wal_lsn", "pg_current_xlog_location"):
+        try:
+            cursor.execute("SELECT %s()::text" % function)
+        except psycopg2.Error:
             continue
+        high, low = cursor.fetchone()[0].split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    return None
+
+def replay_listings(directory):
+    """ loads listings from directory through scan_share as if they came
+    from scanners and reports cost of every load. Listings are named as
+    saves of shares (share_save_str, optionally with '.gz'), shares should
+    exist in the database. If 'name.old' is present too, it is loaded first
+    and 'name' is loaded as a patch to it. Saves are written to a temporary
+    directory, scan_history and trees of the shares are updated as usual """
+    import common
+    db = connectdb("spider")
+    db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT share_id, tree_id, shares.protocol, hostname, port, scan_command
+        FROM shares JOIN scantypes USING (scantype_id)
+        """)
+    shares = dict([(share_save_str(*row[2:5]), tuple(row)) for row in cursor.fetchall()])
+    listings = dict()
+    for file in os.listdir(directory):
+        name = re.sub(r'(\.gz)?(\.old)?$', '', file)
+        kind = 'old' if file.endswith(".old") else 'new'
+        listings.setdefault(name, dict())[kind] = os.path.join(directory, file)
+    common.shares_save_dir = tempfile.mkdtemp(prefix = "uguu-replay")
+    heartbeat = LeaseHeartbeat()
+    # lines, scan, parse and db times, rows and WAL bytes of all loads
+    total = [0, 0.0, 0.0, 0.0, 0, 0]
+    print "%-40s %5s %10s %8s %8s %8s %10s %9s %9s" % ("share", "mode", "lines",
+        "scan", "parse", "db", "rows", "rows/s", "WAL MB")
+    try:
+        for name in sorted(listings.keys()):
+            if name not in shares or 'new' not in listings[name]:
+                log("No share for listing %s, skipped.", (name,))
+                continue
+            share = shares[name]
+            for kind in ('old', 'new'):
+                if kind not in listings[name]:
+                    continue
+                cursor.execute("""
+                    UPDATE shares SET lease_owner = %(o)s, lease_expires = now() + %(l)s * interval '1 second'
+                    WHERE share_id = %(s)s
+                    """, {'s': share[0], 'o': lease_owner(), 'l': lease_time})
+                record = ScanRecord(share[0])
+                before = wal_position(cursor)
+                lines = process_share(db, share, heartbeat, record, listings[name][kind])
+                after = wal_position(cursor)
+                if lines is None:
+                    print "%-40s failed" % sharestr(*share[2:5])
+                    continue
+                changed = record.rows_added + record.rows_deleted + record.rows_modified
+                written = after - before if before is not None and after is not None else 0
+                print "%-40s %5s %10d %7.1fs %7.1fs %7.1fs %10d %9.0f %9.1f" % (
+                    sharestr(*share[2:5]), record.mode, lines, record.scanner_time,
+                    record.parse_time, record.db_time, changed,
+                    changed / max(record.parse_time + record.db_time, 1e-6), written / 1048576.0)
+                for i, value in enumerate((lines, record.scanner_time, record.parse_time,
+                                           record.db_time, changed, written)):
+                    total[i] += value
+    finally:
+        heartbeat.stop()
+        shutil.rmtree(common.shares_save_dir, True)
+        db.close()
+    print "%-40s %5s %10d %7.1fs %7.1fs %7.1fs %10d %9.0f %9.1f" % (("total", "") + tuple(total[:5]) +
+        (total[4] / max(total[2] + total[3], 1e-6), total[5] / 1048576.0))
+
+def get_option(name, default):
+    """ returns int value following the name in command line """
+    if name not in sys.argv:
+        return default
+    try:
+        return int(sys.argv[sys.argv.index(name) + 1])
+    except:
+        print "Invalid value of %s parameter." % name
+        sys.exit(1)
+
+if __name__ == "__main__":
+    if '-h' in sys.argv or 'help' in sys.argv:
+        print "Usage: %s [--workers N] [--daemon] [--bulk] [--restore DIR] [--purge] [--maintain] [--replay DIR]" % sys.argv[0]
+        print "  --workers N\tscan shares with N parallel workers"
+        print "  --daemon\twait for shares to scan instead of exiting, SIGTERM stops it"
+        print "  --bulk\tload the whole database after 'dbinit.py --dropindex', no patches and rebuilds"
+        print "  --restore DIR\tload shares from listings in DIR named as saves instead of scanning"
+        print "  --replay DIR\tload saved listings from DIR instead of scanning and report load times"
+        print "  --purge\tonly delete trees left after rebuilds and names of no files and exit"
+        print "  --maintain\tonly analyze and vacuum tables changed beyond thresholds and exit"
+        sys.exit()
+    if '--purge' in sys.argv:
         try:
-            scan_share(db, id, proto, host, port, tree_id, command)
+            db = connectdb("spider")
+            purge_trees(db)
+            if files_names_table:
+                purge_names(db)
         except KeyboardInterrupt:
             log("Interrupted by user. Exiting")
-            db.rollback()
-            sys.exit(0)
-        except psycopg2.IntegrityError:
-            now = int(time.time())
-            log("SQL Integrity violation while scanning %s. Rename old contents with suffix %s. Next scan to be in non-patching mode", (sharestr(proto, host, port), now))
-            traceback.print_exc()
-            db.rollback()
-            savepath = share_save_path(proto, host, port)
-            if os.path.isfile(savepath):
-                shutil.move(savepath, savepath + "." + str(now))
-            savepath += ".old"
-            if os.path.isfile(savepath):
-                shutil.move(savepath, savepath + "." + str(now))
-        except:
-            log("Scanning %s failed with a crash. Something unexpected happened. Exception trace:", sharestr(proto, host, port))
-            traceback.print_exc()
-            db.rollback()
-
+        sys.exit(0)
+    if '--maintain' in sys.argv:
+        try:
+            maintain_tables(connectdb("spider"))
+        except KeyboardInterrupt:
+            log("Interrupted by user. Exiting")
+        sys.exit(0)
+    if '--replay' in sys.argv:
+        index = sys.argv.index('--replay') + 1
+        if index >= len(sys.argv) or not os.path.isdir(sys.argv[index]):
+            print "Invalid value of --replay parameter."
+            sys.exit(1)
+        try:
+            replay_listings(sys.argv[index])
+        except KeyboardInterrupt:
+            log("Interrupted by user. Exiting")
+        sys.exit(0)
+    workers = get_option('--workers', spider_workers)
+    daemon = '--daemon' in sys.argv
+    bulk_load[0] = '--bulk' in sys.argv
+    restore = None
+    if '--restore' in sys.argv:
+        index = sys.argv.index('--restore') + 1
+        if index >= len(sys.argv) or not os.path.isdir(sys.argv[index]):
+            print "Invalid value of --restore parameter."
+            sys.exit(1)
+        restore = os.path.abspath(sys.argv[index])
+    create_save_dir()
+    if workers > 1:
+        try:
+            run_workers(workers, daemon, bulk_load[0], restore)
+        except KeyboardInterrupt:
+            log("Interrupted by user. Exiting")
+        sys.exit(0)
+    stats = ScanStats()
+    handle_signals(stop_worker)
+    try:
+        spider_worker(stats.add, daemon, restore)
+    except KeyboardInterrupt:
+        log("Interrupted by user. Exiting")
+        sys.exit(0)
+    stats.log()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#
+# treediff.py - makes patches of scanner output like scanners do with '-u'
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import array
+import hashlib
+import shutil
+import tempfile
+from common import open_save, save_compressed
+
+class Listing:
+    """ index of directories of the full listing in scanner output or save.
+    Only offsets of lines are kept in memory, lines are read from the file
+    when they are needed, so file should be seekable and not compressed.
+    Directories of the listing are walked in the same order as 'dt' does,
+    so lines of a directory are found in groups: '0' lines of children,
+    then '1' lines of files, then walks of children, then '1' lines of
+    children. Patch lines and the header are skipped, but counted in digest """
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.md5()
+        self.maxid = 0
+        # own '0' and '1' lines of directories
+        self.zoff = array.array('l')
+        self.loff = array.array('l')
+        self.parent = array.array('l')
+        # groups of children's '0' lines and files' '1' lines
+        self.coff = array.array('l')
+        self.ccount = array.array('l')
+        self.foff = array.array('l')
+        self.fcount = array.array('l')
+        self.valid = self.index()
+    def grow(self, id):
+        if id >= len(self.zoff):
+            n = id + 1 - len(self.zoff)
+            for a in (self.zoff, self.loff, self.parent, self.coff):
+                a.extend([-1] * n)
+            for a in (self.ccount, self.foff, self.fcount):
+                a.extend([0] * n)
+    def index(self):
+        self.file.seek(0)
+        offset = 0
+        # files of a directory go in a row
+        files, parent = None, 0
+        try:
+            for line in self.file:
+                self.digest.update(line)
+                if line[0] == '1':
+                    f = line.split(' ', 5)
+                    if f[4] == '0':
+                        if f[1] != files:
+                            files, parent = f[1], int(f[1])
+                            self.foff[parent] = offset
+                        self.fcount[parent] += 1
+                    else:
+                        dirid = int(f[4])
+                        self.grow(dirid)
+                        self.loff[dirid] = offset
+                        self.parent[dirid] = int(f[1])
+                        files = None
+                elif line[0] == '0':
+                    id = int(line.split(' ', 2)[1])
+                    self.grow(id)
+                    self.zoff[id] = offset
+                    self.maxid = max(self.maxid, id)
+                    files = None
+                offset += len(line)
+        except (IndexError, ValueError):
+            return False
+        if len(self.zoff) < 2 or self.zoff[1] < 0 or self.parent[1] != 0:
+            return False
+        for id in xrange(2, len(self.zoff)):
+            if (self.zoff[id] < 0) != (self.loff[id] < 0):
+                return False
+            parent = self.parent[id]
+            if self.zoff[id] < 0:
+                continue
+            if parent <= 0 or parent >= len(self.zoff) or self.zoff[parent] < 0:
+                return False
+            if self.ccount[parent] == 0 or self.zoff[id] < self.coff[parent]:
+                self.coff[parent] = self.zoff[id]
+            self.ccount[parent] += 1
+        return True
+    def line(self, offset):
+        self.file.seek(offset)
+        return self.file.readline()
+    def lines(self, offset, count):
+        if count == 0:
+            return []
+        self.file.seek(offset)
+        return [self.file.readline() for i in xrange(count)]
+    def path(self, id):
+        """ returns path of directory with the trailing newline """
+        return self.line(self.zoff[id]).split(' ', 2)[2]
+    def children(self, id, path):
+        """ returns [(name, id)] of child directories in name order,
+        path is the directory's own path """
+        # paths of root's children have no leading '/'
+        skip = len(path)
+        if path == "\n":
+            skip = 0
+        children = []
+        for line in self.lines(self.coff[id], self.ccount[id]):
+            f = line.split(' ', 2)
+            children.append((f[2][skip:-1], int(f[1])))
+        return children
+    def files(self, id):
+        """ returns '1' lines of files of directory """
+        return self.lines(self.foff[id], self.fcount[id])
+    def walk(self, id):
+        """ yields lines written by 'dt' while it walks directory """
+        if self.ccount[id] > 0:
+            last = self.children(id, "\n")[-1][1]
+            end = self.loff[last]
+            offset = self.coff[id]
+        elif self.fcount[id] > 0:
+            offset = self.foff[id]
+            end = offset
+            for line in self.files(id)[:-1]:
+                end += len(line)
+        else:
+            return
+        self.file.seek(offset)
+        while offset <= end:
+            line = self.file.readline()
+            offset += len(line)
+            yield line
+    def all(self):
+        """ yields lines of the listing without patch lines """
+        self.file.seek(0)
+        for line in self.file:
+            if line[0] not in ('+', '-', '*'):
+                yield line
+    def close(self):
+        self.file.close()
+
+def listing_file(path):
+    """ returns seekable file of a save or listing, compressed files
+    are decompressed into a temporary file """
+    if not save_compressed(path):
+        return open(path, "rb")
+    file = tempfile.TemporaryFile()
+    source = open_save(path)
+    shutil.copyfileobj(source, file)
+    source.close()
+    return file
+
+def open_listing(path):
+    """ returns Listing of a save or listing file """
+    return Listing(listing_file(path))
+
+class TreeDiff:
+    """ compares listings as dt_diff() in scanners/libuguu/dt.c does.
+    Directories matched by name keep ids of the old listing, new ones
+    get ids after the maximal old id in the order they are met """
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.nextid = old.maxid + 1
+        self.ids = array.array('l', [0]) * max(len(new.zoff), 2)
+        self.ids[1] = 1
+    def add_tree(self, id, parent):
+        """ yields lines of directory appeared in the new listing """
+        new, ids = self.new, self.ids
+        own = new.line(new.loff[id])
+        ids[id] = self.nextid
+        self.nextid += 1
+        yield "+ 0 %s %s" % (ids[id], new.path(id))
+        for line in new.walk(id):
+            if line[0] == '0':
+                f = line.split(' ', 2)
+                ids[int(f[1])] = self.nextid
+                yield "+ 0 %s %s" % (self.nextid, f[2])
+                self.nextid += 1
+            else:
+                f = line.split(' ', 6)
+                yield "+ 1 %s %s %s %s %s %s" % (ids[int(f[1])], f[2], f[3], ids[int(f[4])], f[5], f[6])
+        f = own.split(' ', 6)
+        yield "+ 1 %s %s %s %s %s %s" % (parent, f[2], f[3], ids[id], f[5], f[6])
+    def delete_tree(self, id):
+        """ yields lines of directory disappeared from the new listing """
+        old = self.old
+        own = old.line(old.loff[id])
+        yield "- " + old.line(old.zoff[id])
+        for line in old.walk(id):
+            if line[0] == '0':
+                yield "- " + line
+        yield "- " + own
+    def enter(self, nid, oid, matched):
+        """ yields changes of directory's children, fills matched with
+        pairs of ids of subdirectories present in both listings """
+        old, new = self.old, self.new
+        path = new.path(nid)
+        header = ["* 0 %s %s" % (oid, path)]
+        def changed():
+            # directory is printed once before its first change
+            if header:
+                return [header.pop()]
+            return []
+        ochildren = old.children(oid, path)
+        nchildren = new.children(nid, path)
+        i = j = 0
+        while i < len(ochildren) and j < len(nchildren):
+            if ochildren[i][0] == nchildren[j][0]:
+                self.ids[nchildren[j][1]] = ochildren[i][1]
+                matched.append((nchildren[j][1], ochildren[i][1]))
+                i += 1
+                j += 1
+            elif ochildren[i][0] < nchildren[j][0]:
+                for line in changed():
+                    yield line
+                for line in self.delete_tree(ochildren[i][1]):
+                    yield line
+                i += 1
+            else:
+                for line in changed():
+                    yield line
+                for line in self.add_tree(nchildren[j][1], oid):
+                    yield line
+                j += 1
+        for child in ochildren[i:]:
+            for line in changed():
+                yield line
+            for line in self.delete_tree(child[1]):
+                yield line
+        for child in nchildren[j:]:
+            for line in changed():
+                yield line
+            for line in self.add_tree(child[1], oid):
+                yield line
+        ofiles = old.files(oid)
+        nfiles = new.files(nid)
+        # lines of unchanged files differ by parent id only
+        if [line[line.index(' ', 2):] for line in ofiles] == [line[line.index(' ', 2):] for line in nfiles]:
+            return
+        ofiles = [line.split(' ', 6) for line in ofiles]
+        nfiles = [line.split(' ', 6) for line in nfiles]
+        i = j = 0
+        while i < len(ofiles) and j < len(nfiles):
+            o, n = ofiles[i], nfiles[j]
+            if o[6] == n[6]:
+                if o[3] != n[3]:
+                    for line in changed():
+                        yield line
+                    yield "* 1 %s %s %s 0 0 %s" % (oid, o[2], n[3], o[6])
+                i += 1
+                j += 1
+            elif o[6] < n[6]:
+                for line in changed():
+                    yield line
+                yield "- 1 %s %s %s 0 0 %s" % (oid, o[2], o[3], o[6])
+                i += 1
+            else:
+                for line in changed():
+                    yield line
+                yield "+ 1 %s %s %s 0 0 %s" % (oid, n[2], n[3], n[6])
+                j += 1
+        for o in ofiles[i:]:
+            for line in changed():
+                yield line
+            yield "- 1 %s %s %s 0 0 %s" % (oid, o[2], o[3], o[6])
+        for n in nfiles[j:]:
+            for line in changed():
+                yield line
+            yield "+ 1 %s %s %s 0 0 %s" % (oid, n[2], n[3], n[6])
+    def leave(self, nid, oid):
+        """ yields change of directory's own size and items """
+        o = self.old.line(self.old.loff[oid]).split(' ', 6)
+        n = self.new.line(self.new.loff[nid]).split(' ', 6)
+        if o[3] != n[3] or o[5] != n[5]:
+            yield "* 1 %s %s %s %s %s %s" % (o[1], o[2], n[3], oid, n[5], o[6])
+    def patch(self):
+        """ yields lines of the patch """
+        # directories are walked without recursion, trees can be deep
+        stack = [(True, 1, 1)]
+        while stack:
+            enter, nid, oid = stack.pop()
+            if not enter:
+                for line in self.leave(nid, oid):
+                    yield line
+                continue
+            matched = []
+            for line in self.enter(nid, oid, matched):
+                yield line
+            stack.append((False, nid, oid))
+            matched.reverse()
+            for nid, oid in matched:
+                stack.append((True, nid, oid))
+    def listing(self):
+        """ yields the new listing with ids of the patch """
+        ids = self.ids
+        parent = prefix = None
+        for line in self.new.all():
+            if line[0] == '0':
+                f = line.split(' ', 2)
+                yield "0 %s %s" % (ids[int(f[1])], f[2])
+                continue
+            i = line.index(' ', 2)
+            if line[2:i] != parent:
+                parent = line[2:i]
+                prefix = "1 %s" % ids[int(parent)]
+            f = line[i:].split(' ', 4)
+            if f[3] == '0':
+                yield prefix + line[i:]
+            else:
+                yield "%s %s %s %s %s" % (prefix, f[1], f[2], ids[int(f[3])], f[4])
+
+def diff(old, new):
+    """ yields lines of scanner output with '-u' for old Listing of the
+    previous save and new Listing of the full scanner output: md5 digest
+    of the old save, patch lines and the new listing with ids of the patch.
+    If the old save can't be used, the new listing is given as is """
+    if not old.valid or not new.valid:
+        for line in new.all():
+            yield line
+        return
+    tree = TreeDiff(old, new)
+    yield "* %s\n" % old.digest.hexdigest()
+    for line in tree.patch():
+        yield line
+    for line in tree.listing():
+        yield line
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Usage: %s old_save new_listing" % sys.argv[0]
+        print "Writes output of scanner with '-u old_save' to stdout."
+        sys.exit()
+    old = open_listing(sys.argv[1])
+    new = open_listing(sys.argv[2])
+    for line in diff(old, new):
+        sys.stdout.write(line)
+    old.close()
+    new.close()
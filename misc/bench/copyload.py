@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# copyload.py - benchmark of full listing loading methods
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import time
+
+from common import connectdb, open_save
+import spider
+import dtparse
+
+def generate_listing(dirs, files):
+    """ flat tree of dirs directories with files files each """
+    yield "0 1 "
+    for d in range(dirs):
+        yield "0 %s dir%06d" % (d + 2, d)
+    for d in range(dirs):
+        for f in range(files):
+            yield "1 %s %s %s 0 0 file %s of dir %s.avi" % (d + 2, f, f * 1024, f, d)
+    for d in range(dirs):
+        yield "1 1 %s %s %s %s dir%06d" % (d, files * (files - 1) * 512, d + 2, files, d)
+    yield "1 0 0 %s 1 %s " % (dirs * files * (files - 1) * 512, dirs)
+
+def read_listing(filename):
+    for line in open_save(filename):
+        if line[0] not in ('+', '-', '*'):
+            yield line.strip('\n')
+
+def scratch_tree(cursor):
+    """ creates temporary share, returns its tree_id """
+    cursor.execute("""
+        INSERT INTO networks (network)
+        SELECT 'bench' WHERE NOT EXISTS
+            (SELECT 1 FROM networks WHERE network = 'bench');
+        INSERT INTO shares (scantype_id, network, protocol, hostname)
+        VALUES ((SELECT min(scantype_id) FROM scantypes), 'bench', 'smb', 'bench.invalid')
+        RETURNING share_id;
+        """)
+    share_id = cursor.fetchone()[0]
+    cursor.execute("SELECT tree_id FROM shares WHERE share_id = %(s)s", {'s': share_id})
+    return cursor.fetchone()[0]
+
+def load_insert(cursor, tree, lines):
+    qcache = spider.PsycoCache(cursor)
+    paths_buffer = dtparse.DirTable()
+    for line in lines:
+        spider.scan_line_patch(cursor, tree, "+ " + line, qcache, paths_buffer)
+    qcache.allcommit()
+
+def load_copy(cursor, tree, lines):
+    loader = spider.CopyLoader(cursor)
+    for line in lines:
+        spider.scan_line_full(line, loader)
+    loader.commit(tree)
+
+def measure(db, name, method, lines):
+    cursor = db.cursor()
+    cursor.execute("SAVEPOINT bench")
+    tree = scratch_tree(cursor)
+    start = time.time()
+    method(cursor, tree, lines)
+    elapsed = time.time() - start
+    cursor.execute("ROLLBACK TO SAVEPOINT bench")
+    print "%-8s %8d rows %8.2f s %10.1f rows/s" % (name, len(lines), elapsed, len(lines) / max(elapsed, 1e-6))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '-g':
+        lines = list(generate_listing(int(sys.argv[2]), int(sys.argv[3])))
+    elif len(sys.argv) == 2:
+        lines = list(read_listing(sys.argv[1]))
+    else:
+        print "Usage: %s [listing | -g dirs files_per_dir]" % sys.argv[0]
+        sys.exit()
+    try:
+        db = connectdb("benchmark")
+    except:
+        print "Unable to connect to the database, exiting."
+        sys.exit()
+    measure(db, "insert", load_insert, lines)
+    measure(db, "copy", load_copy, lines)
+    db.rollback()
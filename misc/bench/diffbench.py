@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# diffbench.py - benchmark of making patches by treediff module
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import time
+import random
+import resource
+import tempfile
+
+import treediff
+
+def generate_tree(dirs, files):
+    """ tree of dirs directories with fanout 8 and files files each,
+    directories are dicts, files are sizes """
+    tree = [dict() for d in range(dirs)]
+    for d in range(1, dirs):
+        tree[(d - 1) / 8]["dir%06d" % d] = tree[d]
+    for d in range(dirs):
+        for f in range(files):
+            tree[d]["file %s of dir %s.avi" % (f, d)] = f * 1024
+    return tree[0]
+
+def change_tree(tree, percent, seed = 1):
+    """ deletes, modifies and adds percent of files,
+    deletes and adds percent / 10 of directories """
+    rand = random.Random(seed)
+    stack = [tree]
+    while stack:
+        dir = stack.pop()
+        for name in dir.keys():
+            if isinstance(dir[name], dict):
+                if rand.random() * 1000 < percent:
+                    del dir[name]
+                else:
+                    stack.append(dir[name])
+                continue
+            r = rand.random() * 100
+            if r < percent:
+                del dir[name]
+            elif r < 2 * percent:
+                dir[name] += 1
+            elif r < 3 * percent:
+                dir["new " + name] = 1
+        if rand.random() * 1000 < percent:
+            dir["new dir"] = {"new file": 1}
+
+def write_listing(tree, file):
+    """ writes tree in the same order and with the same ids as
+    dt_reverse() in scanners/libuguu/dt.c """
+    ids = [1]
+    def walk(dir, id, path):
+        dirs = sorted([n for n in dir if isinstance(dir[n], dict)])
+        files = sorted([n for n in dir if not isinstance(dir[n], dict)])
+        prefix = path + "/" if path else ""
+        children = []
+        for name in dirs:
+            ids[0] += 1
+            children.append(ids[0])
+            file.write("0 %s %s%s\n" % (ids[0], prefix, name))
+        size = 0
+        for i in range(len(files)):
+            file.write("1 %s %s %s 0 0 %s\n" % (id, len(dirs) + i, dir[files[i]], files[i]))
+            size += dir[files[i]]
+        stats = [walk(dir[dirs[i]], children[i], prefix + dirs[i]) for i in range(len(dirs))]
+        for i in range(len(dirs)):
+            file.write("1 %s %s %s %s %s %s\n" % (id, i, stats[i][0], children[i], stats[i][1], dirs[i]))
+            size += stats[i][0]
+        return size, len(dir)
+    file.write("0 1 \n")
+    size, items = walk(tree, 1, "")
+    file.write("1 0 0 %s 1 %s \n" % (size, items))
+    file.seek(0)
+
+def measure(old, new):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    old, new = treediff.Listing(old), treediff.Listing(new)
+    indexed = time.time()
+    lines = patch = 0
+    for line in treediff.diff(old, new):
+        lines += 1
+        if line[0] in ('+', '-', '*'):
+            patch += 1
+    elapsed = time.time() - start
+    print "index %.2f s, diff %.2f s, %d patch lines, %d lines total, %.1f lines/s" % (
+        indexed - start, elapsed - (indexed - start), patch, lines, lines / max(elapsed, 1e-6))
+    print "peak memory %s kB (%s kB before diff)" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, before)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == '-g':
+        dirs, files, percent = [int(x) for x in sys.argv[2:]]
+        old, new = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        tree = generate_tree(dirs, files)
+        write_listing(tree, old)
+        change_tree(tree, percent)
+        write_listing(tree, new)
+        del tree
+    elif len(sys.argv) == 3:
+        # saves are decompressed before measuring
+        old, new = treediff.listing_file(sys.argv[1]), treediff.listing_file(sys.argv[2])
+    else:
+        print "Usage: %s [old_save new_listing | -g dirs files_per_dir change_percent]" % sys.argv[0]
+        sys.exit()
+    measure(old, new)
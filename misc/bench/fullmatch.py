@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# fullmatch.py - benchmark of path vectors per file against per directory
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import time
+
+from common import connectdb, files_names_table
+
+# match:full before path vectors were moved to paths: every file had
+# a copy of its directory's vector indexed together with its name
+match_old = "tspath || tsname @@ to_tsquery('uguu', %(q)s)"
+
+# match:full of webuguu/search/views.py: by name or by path and name,
+# every subset of words is matched by path and the rest by name
+match_name = "SELECT file_id FROM files WHERE tsname @@ to_tsquery('uguu', %(q)s)"
+match_path = """SELECT f.file_id FROM paths AS p
+    JOIN files AS f USING (tree_id, treepath_id)
+    WHERE p.tspath @@ to_tsquery('uguu', %%(p%(n)s)s)"""
+match_rest = " AND f.tsname @@ to_tsquery('uguu', %%(r%(n)s)s)"
+# path matching any word instead of subsets, views.py does it for
+# more than match_full_words words
+match_any = """SELECT f.file_id FROM paths AS p
+    JOIN files AS f USING (tree_id, treepath_id)
+    WHERE p.tspath @@ to_tsquery('uguu', %(any)s)
+        AND p.tspath || f.tsname @@ to_tsquery('uguu', %(q)s)"""
+
+if files_names_table:
+    match_name = """SELECT file_id FROM files
+    WHERE name_id IN (SELECT name_id FROM names WHERE tsname @@ to_tsquery('uguu', %(q)s))"""
+    match_rest = """ AND f.name_id IN (
+        SELECT name_id FROM names WHERE tsname @@ to_tsquery('uguu', %%(r%(n)s)s))"""
+    match_any = """SELECT f.file_id FROM paths AS p
+    JOIN files AS f USING (tree_id, treepath_id)
+    JOIN names AS n USING (name_id)
+    WHERE p.tspath @@ to_tsquery('uguu', %(any)s)
+        AND p.tspath || n.tsname @@ to_tsquery('uguu', %(q)s)"""
+
+def match_subsets(words, vars):
+    """ condition of match:full as match_full() of views.py makes it """
+    parts = [match_name]
+    for n in xrange(1, 2 ** len(words)):
+        vars['p%s' % n] = " & ".join([words[i] for i in xrange(len(words)) if n & (1 << i)])
+        rest = [words[i] for i in xrange(len(words)) if not n & (1 << i)]
+        part = match_path % {'n': n}
+        if rest:
+            vars['r%s' % n] = " & ".join(rest)
+            part += match_rest % {'n': n}
+        parts.append(part)
+    return "file_id IN (\n    %s)" % "\n    UNION ALL\n    ".join(parts)
+
+def old_layout(cursor):
+    """ copies files with vectors of their paths into oldfiles as they
+    were stored before, returns seconds spent on the copy and its index """
+    start = time.time()
+    tsname = "n.tsname" if files_names_table else "f.tsname"
+    names = "LEFT JOIN names AS n USING (name_id)" if files_names_table else ""
+    cursor.execute("""
+        CREATE TEMPORARY TABLE oldfiles ON COMMIT DROP AS
+            SELECT f.file_id, %s AS tsname, p.tspath
+            FROM files AS f JOIN paths AS p USING (tree_id, treepath_id) %s;
+        CREATE INDEX oldfiles_tsfullpath ON oldfiles USING gin((tspath || tsname)) WITH (FASTUPDATE = OFF);
+        ANALYZE oldfiles;
+        """ % (tsname, names))
+    return time.time() - start
+
+def sizes(cursor):
+    """ bytes of path vectors and their indexes in both layouts, index
+    of partitioned paths is summed over its partitions """
+    cursor.execute("""
+        SELECT (SELECT sum(pg_column_size(tspath)) FROM oldfiles) AS old_data,
+            pg_relation_size('oldfiles_tsfullpath') AS old_index,
+            (SELECT sum(pg_column_size(tspath)) FROM paths) AS new_data,
+            (SELECT sum(pg_relation_size(coalesce(i.inhrelid, t.oid)))::float8
+                FROM pg_class AS t LEFT JOIN pg_inherits AS i ON i.inhparent = t.oid
+                WHERE t.relname = 'paths_tspath' AND pg_table_is_visible(t.oid)) AS new_index
+        """)
+    row = cursor.fetchone()
+    mb = lambda x: (x or 0) / 1048576.0
+    print "%-10s %12s %12s" % ("", "vectors MB", "index MB")
+    print "%-10s %12.1f %12.1f" % ("per file", mb(row['old_data']), mb(row['old_index']))
+    print "%-10s %12.1f %12.1f" % ("per path", mb(row['new_data']), mb(row['new_index']))
+
+def latency(cursor, table, condition, vars, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        cursor.execute("SELECT count(*) FROM %s WHERE %s" % (table, condition), vars)
+        count = cursor.fetchone()[0]
+        times.append(time.time() - start)
+    return count, min(times), sum(times) / len(times)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: %s [-r repeat] word [word ...]" % sys.argv[0]
+        sys.exit()
+    args = sys.argv[1:]
+    repeat = 5
+    if args[0] == '-r' and len(args) > 2:
+        repeat = int(args[1])
+        args = args[2:]
+    try:
+        db = connectdb("benchmark")
+    except:
+        print "Unable to connect to the database, exiting."
+        sys.exit()
+    cursor = db.cursor()
+    print "Copying files to the old layout took %.1f s." % old_layout(cursor)
+    sizes(cursor)
+    vars = {'q': " & ".join(args), 'any': " | ".join(args)}
+    subsets = match_subsets(args, vars)
+    anyword = "file_id IN (%s UNION ALL %s)" % (match_name, match_any)
+    print "%-10s %10s %10s %10s" % ("", "matches", "min ms", "avg ms")
+    for name, table, condition in (("per file", "oldfiles", match_old), ("any word", "files", anyword),
+                                   ("per path", "files", subsets)):
+        count, best, average = latency(cursor, table, condition, vars, repeat)
+        print "%-10s %10d %10.1f %10.1f" % (name, count, best * 1000, average * 1000)
+    db.rollback()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# parseline.py - microbenchmark of scanner output parsing
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import time
+import string
+
+import dtparse
+from common import open_save
+
+def parse_split(line):
+    """ parsing as spider did it before dtparse: whole line is decoded,
+    split with string.split and converted with int() field by field """
+    line = unicode(line.strip('\n'), "utf-8")
+    if line[0] in ('+', '-', '*'):
+        line = line[2:]
+    if line[0] == "0":
+        try:
+            l, id, path = string.split(s = line, sep = ' ', maxsplit = 2)
+        except:
+            l, id = string.split(s = line, sep = ' ', maxsplit = 2)
+            path = ""
+        return {'id': int(id), 'p': path}
+    try:
+        l, path, file, size, dirid, items, name = string.split(s = line, sep = ' ', maxsplit = 6)
+    except:
+        l, path, file, size, dirid, items = string.split(s = line, sep = ' ', maxsplit = 6)
+        name = ""
+    return {'p': int(path), 'f': int(file), 'sz': int(size),
+            'did': int(dirid), 'i': int(items), 'n': name}
+
+def track_dict(records):
+    buf = dict()
+    for rec in records:
+        if rec[1] == dtparse.PATH:
+            buf[rec[2]] = rec[3]
+        elif rec[5] > 0:
+            buf.pop(rec[5], None)
+
+def track_table(records):
+    buf = dtparse.DirTable()
+    for rec in records:
+        if rec[1] == dtparse.PATH:
+            buf.add(rec[2])
+        elif rec[5] > 0:
+            buf.pop(rec[5])
+
+def measure(name, method, arg, count):
+    start = time.time()
+    method(arg)
+    elapsed = time.time() - start
+    print "%-8s %10d lines %8.2f s %12.1f lines/s" % (name, count, elapsed, count / max(elapsed, 1e-6))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "Usage: %s listing" % sys.argv[0]
+        sys.exit()
+    file = open_save(sys.argv[1])
+    lines = file.readlines()
+    file.close()
+    if len(lines) > 0 and lines[0][0] == '*' and lines[0][3] != ' ':
+        # md5 header of the patch
+        del lines[0]
+    count = len(lines)
+    measure("split", lambda l: [parse_split(x) for x in l], lines, count)
+    measure("dtparse", lambda l: [dtparse.parse_line(x) for x in l], lines, count)
+    records = [dtparse.parse_line(x) for x in lines]
+    measure("dict", track_dict, records, count)
+    measure("table", track_table, records, count)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# patchbatch.py - benchmark of patch applying by single-row and
+#                 multi-row statements
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import time
+
+from common import connectdb, open_save
+import spider
+from copyload import read_listing, scratch_tree, load_copy
+
+def apply_patch(cursor, tree, patch):
+    loader = spider.ShareLoader(cursor, tree, patch[0][2:].strip('\n'))
+    for line in patch:
+        loader.feed(line)
+    return loader.finish()
+
+def measure(db, name, batched, old, patch):
+    spider.patch_batch_statements = batched
+    cursor = db.cursor()
+    cursor.execute("SAVEPOINT bench")
+    tree = scratch_tree(cursor)
+    load_copy(cursor, tree, old)
+    start = time.time()
+    qcache = apply_patch(cursor, tree, patch)
+    elapsed = time.time() - start
+    cursor.execute("ROLLBACK TO SAVEPOINT bench")
+    changes = qcache.stat_pdelete + qcache.stat_fdelete + qcache.stat_fmodify + qcache.stat_padd + qcache.stat_fadd
+    print "%-8s %8d changes %8.2f s %10.1f changes/s" % (name, changes, elapsed, changes / max(elapsed, 1e-6))
+    return elapsed
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Usage: %s old_save patched_save" % sys.argv[0]
+        sys.exit()
+    old = list(read_listing(sys.argv[1]))
+    patch = [line for line in open_save(sys.argv[2])]
+    if len(patch) == 0 or patch[0][0] != '*':
+        print "%s doesn't start with a patch" % sys.argv[2]
+        sys.exit()
+    try:
+        db = connectdb("benchmark")
+    except:
+        print "Unable to connect to the database, exiting."
+        sys.exit()
+    single = measure(db, "single", False, old, patch)
+    multi = measure(db, "multi", True, old, patch)
+    print "speedup %.2f" % (single / max(multi, 1e-6))
+    db.rollback()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# pushfiles.py - benchmark of files renumbering in patching mode
+#
+# Copyright 2010, savrus
+# Read the COPYING file in the root of the source tree.
+#
+
+import sys
+import time
+
+from common import connectdb
+from copyload import generate_listing, scratch_tree, load_copy
+
+def add_files(cursor, tree, dirs, files, added):
+    """ puts added new files to every directory as patch does,
+    new files are spread evenly between the old ones """
+    stride = (files + added) / added
+    cursor.execute("""
+        CREATE TEMPORARY TABLE newfiles (
+            LIKE files INCLUDING DEFAULTS
+            ) ON COMMIT DROP;
+        CREATE INDEX newfiles_path ON newfiles(treepath_id);
+        INSERT INTO newfiles (tree_id, treepath_id, pathfile_id, name)
+            SELECT %(t)s, d, g * %(s)s, 'new file ' || g
+            FROM generate_series(2, %(d)s + 1) AS d,
+                generate_series(0, %(a)s - 1) AS g;
+        """, {'t': tree, 'd': dirs, 'a': added, 's': stride})
+    return range(2, dirs + 2)
+
+def push_loop(cursor, tree, dirs):
+    for dirid in dirs:
+        cursor.execute("SELECT push_path_files(%(t)s, %(d)s)", {'t': tree, 'd': dirid})
+
+def push_set(cursor, tree, dirs):
+    cursor.execute("SELECT push_tree_files(%(t)s, %(d)s)", {'t': tree, 'd': dirs})
+
+def measure(db, name, method, dirs, files, added):
+    cursor = db.cursor()
+    cursor.execute("SAVEPOINT bench")
+    tree = scratch_tree(cursor)
+    load_copy(cursor, tree, generate_listing(dirs, files))
+    dirids = add_files(cursor, tree, dirs, files, added)
+    start = time.time()
+    method(cursor, tree, dirids)
+    elapsed = time.time() - start
+    # digest of resulting order, should be the same for all methods
+    cursor.execute("""
+        SELECT md5(string_agg(name, '/' ORDER BY treepath_id, pathfile_id))
+        FROM files WHERE tree_id = %(t)s
+        """, {'t': tree})
+    digest = cursor.fetchone()[0]
+    cursor.execute("ROLLBACK TO SAVEPOINT bench")
+    print "%-8s %8d dirs %8.2f s %10.1f dirs/s  %s" % (name, dirs, elapsed, dirs / max(elapsed, 1e-6), digest)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print "Usage: %s dirs files_per_dir added_per_dir" % sys.argv[0]
+        sys.exit()
+    dirs, files, added = [int(x) for x in sys.argv[1:]]
+    try:
+        db = connectdb("benchmark")
+    except:
+        print "Unable to connect to the database, exiting."
+        sys.exit()
+    measure(db, "loop", push_loop, dirs, files, added)
+    measure(db, "set", push_set, dirs, files, added)
+    db.rollback()
@@ -11,7 +11,7 @@ import os.path
 import sys
 import subprocess
 
-from common import connectdb, scanners_path, db_host, db_user, db_password, db_database, share_save_str, share_save_path
+from common import connectdb, scanners_path, db_host, db_user, db_password, db_database, share_save_str, share_save_find, SaveInput
 
 shares_dump_dir = 'dump'
 shares_dump_dir = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), shares_dump_dir)
@@ -76,9 +76,11 @@ if __name__ == "__main__":
     skipmode = 'only' in sys.argv
     if 'diff' in sys.argv:
         for share in shares.fetchall():
-            savepath = share_save_path(share['protocol'], share['hostname'], share['port'])
-            if os.path.isfile(savepath):
-                dump = dump_share(share,savepath)
+            savepath = share_save_find(share['protocol'], share['hostname'], share['port'])
+            if savepath is not None:
+                saveinput = SaveInput(savepath)
+                dump = dump_share(share,saveinput.path)
+                saveinput.close()
                 if skipmode and zero_diff(dump):
                     os.unlink(dump)
             elif not skipmode:
@@ -12,7 +12,7 @@ import os.path
 import hashlib
 import subprocess
 
-from common import connectdb, scanners_path, db_host, db_user, db_password, db_database, share_save_path
+from common import connectdb, scanners_path, db_host, db_user, db_password, db_database, share_save_find, open_save
 
 def update_share(share, cursor):
     print "Updating hash for %(proto)s://%(host)s:%(port)s" \
@@ -21,7 +21,7 @@ def update_share(share, cursor):
            'host': share['hostname']}
     try:
         hash = hashlib.md5()
-        for line in open(share_save_path(share['protocol'], share['hostname'], share['port']), "rt"):
+        for line in open_save(share_save_find(share['protocol'], share['hostname'], share['port'])):
             hash.update(line)
     except:
         cursor.execute("UPDATE trees SET hash='' WHERE tree_id=%(i)s", {'i': share['tree_id']})
@@ -29,6 +29,7 @@ def connectdb(app):
     return conn
 
 # this must be the same as in bin/common.py
+files_names_table = False
 known_protocols = ('smb', 'ftp', 'http')
 known_filetypes = ('dir', 'video', 'audio', 'archive', 'cdimage', 'exe', 'lib',
                    'script', 'image', 'document')
@@ -13,7 +13,7 @@ from django.template import Context, Template
 import string
 import re
 import time
-from webuguu.common import connectdb, offset_prepare, protocol_prepare, vfs_items_per_page, search_items_per_page, usertypes, known_filetypes, known_protocols, debug_virtual_host, rss_items, rss_feed_add_item, hostname_prepare
+from webuguu.common import connectdb, offset_prepare, protocol_prepare, vfs_items_per_page, search_items_per_page, usertypes, known_filetypes, known_protocols, debug_virtual_host, rss_items, rss_feed_add_item, hostname_prepare, files_names_table
 
 # for ordering query option 
 qopt_order = {
@@ -39,14 +39,69 @@ qopt_order = {
     'sharesize.d':   "shares.size",
 }
 
+# full match is by name alone or by path of directory and name together.
+# Every subset of words is matched by path and the rest by name, so both
+# sides are selective, see match_full()
+match_full_name = "SELECT file_id FROM files WHERE tsname @@ to_tsquery('uguu', %(query)s)"
+match_full_path = """SELECT f.file_id FROM paths AS p
+        JOIN files AS f USING (tree_id, treepath_id)
+        WHERE p.tspath @@ to_tsquery('uguu', %%(fp%(n)s)s)"""
+match_full_rest = " AND f.tsname @@ to_tsquery('uguu', %%(fn%(n)s)s)"
+# path of the directory matches at least one word, it isn't selective
+match_full_any = """SELECT f.file_id FROM paths AS p
+        JOIN files AS f USING (tree_id, treepath_id)
+        WHERE p.tspath @@ to_tsquery('uguu', %(anyquery)s)
+            AND p.tspath || f.tsname @@ to_tsquery('uguu', %(query)s)"""
+
+# queries of more words are matched by match_full_any
+match_full_words = 4
+
+# condition of full match is made of words by match_full()
+qopt_match_full = "full"
+
 qopt_match = {
     'name': "files.tsname @@  to_tsquery('uguu', %(query)s)",
-    'full': "files.tspath || files.tsname @@ to_tsquery('uguu',%(query)s)",
+    'full': qopt_match_full,
     'name.p': "files.tsname @@  to_tsquery('uguu', %(query)s)",
-    'full.p': "files.tspath || files.tsname @@ to_tsquery('uguu',%(query)s)",
+    'full.p': qopt_match_full,
     'exact': "lower(files.name) = lower(%(equery)s)",
 }
 
+# names of files are in names table, they are matched there first
+if files_names_table:
+    match_full_name = """SELECT file_id FROM files
+        WHERE name_id IN (SELECT name_id FROM names WHERE tsname @@ to_tsquery('uguu', %(query)s))"""
+    match_full_rest = """ AND f.name_id IN (
+            SELECT name_id FROM names WHERE tsname @@ to_tsquery('uguu', %%(fn%(n)s)s))"""
+    match_full_any = """SELECT f.file_id FROM paths AS p
+        JOIN files AS f USING (tree_id, treepath_id)
+        JOIN names AS n USING (name_id)
+        WHERE p.tspath @@ to_tsquery('uguu', %(anyquery)s)
+            AND p.tspath || n.tsname @@ to_tsquery('uguu', %(query)s)"""
+    qopt_match.update({
+        'name': "files.name_id IN (SELECT name_id FROM names WHERE tsname @@ to_tsquery('uguu', %(query)s))",
+        'name.p': "files.name_id IN (SELECT name_id FROM names WHERE tsname @@ to_tsquery('uguu', %(query)s))",
+        'exact': "files.name_id IN (SELECT name_id FROM names WHERE lname = lower(%(equery)s))",
+    })
+
+def match_full(words, options):
+    """ returns condition of full match of words, puts queries
+    of subsets of words matched by paths and names into options """
+    parts = [match_full_name]
+    if len(words) > match_full_words:
+        parts.append(match_full_any)
+    else:
+        for n in xrange(1, 2 ** len(words)):
+            path = [words[i] for i in xrange(len(words)) if n & (1 << i)]
+            rest = [words[i] for i in xrange(len(words)) if not n & (1 << i)]
+            options['fp%s' % n] = string.join(path, " & ")
+            part = match_full_path % {'n': n}
+            if rest:
+                options['fn%s' % n] = string.join(rest, " & ")
+                part += match_full_rest % {'n': n}
+            parts.append(part)
+    return "files.file_id IN (\n        %s)" % string.join(parts, "\n        UNION ALL\n        ")
+
 class QueryParser:
     def size2byte(self, size):
         sizenotatios = {'b':1, 'k':2 ** 10, 'm':2 ** 20, 'g':2 ** 30, 't':2 ** 40,
@@ -201,8 +256,11 @@ class QueryParser:
             ## prefix search in postgres 8.4, for postgres 8.3 just remove
             words = [x + ":*" for x in words]
         self.options['query'] = string.join(words, " & ")
+        self.options['anyquery'] = string.join(words, " | ")
         equery = re.search(r'(?u)(?P<equery>[^:]*) \w+:', query, re.UNICODE)
         self.options['equery'] = equery.group('equery') if equery else "NULL"
+        if self.filecond == qopt_match_full:
+            self.filecond = match_full(words, self.options)
         self.conditions.append(self.filecond)
         self.sqlquery = "WHERE " + string.join(self.conditions, " AND ")
     def setoption(self, opt, val):